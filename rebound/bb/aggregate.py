@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import copy
+import numpy as np
+import scipy.sparse as sps
+import labelindex
+
+
+# -- operators built from label files, keyed on (path, mtime, rows, cols)
+_CACHE = {}
+
+
+class LabelAggregator(object):
+    """
+    Sparse label -> pixel operator for computing per-source sums and means
+    of a batch of images (frames or bands) with a single sparse mat-mat
+    product, instead of one scipy.ndimage.measurements pass per image.
+
+    Parameters
+    ----------
+    labels : ndarray or labelindex.LabelIndex
+        2-d array of labeled sources (nrows x ncols), 0 is background, or
+        its index (the operator is then built without scanning the mask).
+    index : array-like, optional
+        Labels to aggregate over, in output order.  Defaults to the sorted
+        unique labels excluding 0 (matching np.unique(labels)[1:]).
+
+    Attributes
+    ----------
+    index : ndarray
+        Labels corresponding to the output columns.
+    sizes : ndarray
+        Number of pixels in each label of index.
+    matrix : scipy.sparse.csr_matrix
+        Operator of shape (nlabels x npixels).
+    """
+
+    def __init__(self, labels, index=None):
+
+        if isinstance(labels, labelindex.LabelIndex):
+            self._from_index(labels, index)
+            return
+
+        labels = np.asarray(labels)
+        flat   = labels.ravel()
+
+        if index is None:
+            index = np.unique(flat)
+            index = index[index != 0]
+
+        self.shape = labels.shape
+        self.index = np.asarray(index)
+
+        # -- map each pixel to its row in the operator (skip if not indexed)
+        order  = np.argsort(self.index, kind="mergesort")
+        sindex = self.index[order]
+        pos    = np.searchsorted(sindex, flat).clip(0, sindex.size - 1)
+        hit    = sindex[pos] == flat
+        rows   = order[pos[hit]]
+        pix    = np.flatnonzero(hit)
+
+        self.sizes  = np.bincount(rows, minlength=self.index.size)
+        self.matrix = sps.csr_matrix((np.ones(rows.size), (rows, pix)),
+                                     shape=(self.index.size, flat.size))
+
+        # -- operators for shifted images (see shifted)
+        self._shifted = {}
+
+    def _from_index(self, lidx, index):
+        """
+        Build the operator from a labelindex.LabelIndex (its CSR layout is
+        the operator's).
+        """
+
+        npix   = lidx.shape[0] * lidx.shape[1]
+        matrix = sps.csr_matrix((np.ones(lidx.pixels.size), lidx.pixels, lidx.indptr),
+                                shape=(lidx.labels.size, npix))
+
+        if index is not None:
+            # -- reorder rows (labels not in the mask get an empty row)
+            matrix = sps.vstack([matrix, sps.csr_matrix((1, npix))]).tocsr()
+            matrix = matrix[lidx.position(index)]
+
+        self.shape    = lidx.shape
+        self.index    = lidx.labels if index is None else np.asarray(index)
+        self.matrix   = matrix
+        self.sizes    = np.diff(matrix.indptr)
+        self._shifted = {}
+
+    def sum(self, imgs, batch=64):
+        """
+        Sum of pixel values within each label.
+
+        Parameters
+        ----------
+        imgs : ndarray
+            Single image (nrows x ncols) or stack of images
+            (nimgs x nrows x ncols).
+        batch : int, optional
+            Number of images reshaped and reduced at once.
+
+        Returns
+        -------
+        ndarray
+            Float64 sums, shape (nlabels,) or (nimgs x nlabels).
+        """
+
+        if imgs.ndim == 2:
+            return self.sum(imgs[np.newaxis], batch)[0]
+
+        out = np.empty((imgs.shape[0], self.index.size))
+
+        for ii in range(0, imgs.shape[0], batch):
+            flat = imgs[ii:ii + batch].reshape(-1, self.matrix.shape[1])
+            out[ii:ii + batch] = self.matrix.dot(flat.T).T
+
+        return out
+
+    def mean(self, imgs, batch=64):
+        """
+        Mean of pixel values within each label (see sum).
+        """
+
+        return self.sum(imgs, batch) / self.sizes
+
+    def shifted(self, dr, dc):
+        """
+        Operator for images that are shifted by an integer (dr, dc) with
+        respect to the labels, i.e. each label pixel (r, c) is read at
+        (r + dr, c + dc); pixels shifted out of the image are dropped (and
+        not counted in sizes).  Operators are cached per shift.
+        """
+
+        dr, dc = int(dr), int(dc)
+
+        if (dr, dc) == (0, 0):
+            return self
+
+        if (dr, dc) not in self._shifted:
+            nrow, ncol = self.shape
+            mat  = self.matrix
+            rows = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+            rr   = mat.indices // ncol + dr
+            cc   = mat.indices % ncol + dc
+            keep = (rr >= 0) & (rr < nrow) & (cc >= 0) & (cc < ncol)
+
+            new = copy.copy(self)
+            new.matrix = sps.csr_matrix((mat.data[keep], (rows[keep], rr[keep] * ncol + cc[keep])),
+                                        shape=mat.shape)
+            new.sizes  = np.bincount(rows[keep], minlength=self.index.size)
+            new._shifted = {}
+
+            self._shifted[(dr, dc)] = new
+
+        return self._shifted[(dr, dc)]
+
+
+def from_file(fname, rows=None, cols=None):
+    """
+    Return a (cached) LabelAggregator for a saved label mask.
+
+    Parameters
+    ----------
+    fname : str
+        Path to a .npy label mask (e.g. labels.npy or hsi_pixels3.npy).
+    rows, cols : tuple, optional
+        (start, stop) of a sub-region of the mask (e.g. Gowanus).
+
+    Returns
+    -------
+    LabelAggregator
+        The operator, built only once per file version and sub-region.
+    """
+
+    key = (os.path.abspath(fname), os.path.getmtime(fname), rows, cols)
+
+    if key not in _CACHE:
+        lidx = labelindex.from_file(fname)
+
+        if rows is not None or cols is not None:
+            lidx = lidx.crop((0, lidx.shape[0]) if rows is None else rows,
+                             (0, lidx.shape[1]) if cols is None else cols)
+
+        _CACHE[key] = LabelAggregator(lidx)
+
+    return _CACHE[key]
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import types
 import numpy as np
-import pandas as pd
+import labelindex
 
 
 # topdirectory for 2017 broadband raw images
@@ -13,37 +15,81 @@ DATA_FILEPATH = os.path.join(os.environ['REBOUND_DATA'], 'bb', '2017')
 IMG_SHAPE = (3072, 4096)
 
 # final boolean mask
-BOOL_MASK = np.load(os.path.join(
-    os.environ['REBOUND_WRITE'], 'final', 'mask.npy'))
+BOOL_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'final', 'mask.npy')
 
 # final mask with labels
-LABELS_MASK = np.load(os.path.join(
-    os.environ['REBOUND_WRITE'], 'final', 'labels.npy'))
+LABELS_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'final', 'labels.npy')
 
 # lightcurves directory
 CURVES_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'lightcurves')
 
+# consolidated lightcurve / edge store (see lcstore.py)
+STORE_PATH = os.path.join(os.environ['REBOUND_WRITE'], 'lcstore')
+
 # on and off edges directory
 EDGE_PATH = os.path.join(os.environ['REBOUND_WRITE'], 'edges')
 
 # bb-hsi merged mask
-FINAL_MASK = np.load(os.path.join(
-    os.environ['REBOUND_WRITE'], 'final', 'hsi_pixels3.npy'))
+FINAL_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'final', 'hsi_pixels3.npy')
 
-# dataframe of spectra classes for 0.4 threshold
-df = pd.read_csv(os.path.join(os.environ['REBOUND_WRITE'], 'types.csv'))
-SPECTRA_CLASS = df[df[df.columns[-1]] >= 0.35]
+# spectra classes
+TYPES_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'types.csv')
 
 # length of lightcurves (i.e. number of timesteps)
 CURVE_LENGTH = 2700
 
-# number of lightcurves created
-NUM_CURVES = len([name for name in os.listdir(CURVES_FILEPATH)
-                  if os.path.isfile(os.path.join(CURVES_FILEPATH, name))])
 
-# number of edges created
-NUM_EDGES = len([name for name in os.listdir(
-    EDGE_PATH) if os.path.isfile(os.path.join(EDGE_PATH, name))])
+# -- settings that require reading data are resolved on first access
+
+def _spectra_class(mod):
+    import pandas as pd
+
+    # dataframe of spectra classes for 0.4 threshold
+    df = pd.read_csv(mod.TYPES_FILEPATH)
+
+    return df[df[df.columns[-1]] >= 0.35]
+
+
+def _num_files(path):
+    return len([name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))])
+
+
+_LAZY = {
+    'BOOL_MASK'     : lambda mod: np.load(mod.BOOL_FILEPATH),
+    'LABELS_MASK'   : lambda mod: np.load(mod.LABELS_FILEPATH),
+    'FINAL_MASK'    : lambda mod: np.load(mod.FINAL_FILEPATH),
+    'SPECTRA_CLASS' : _spectra_class,
+    'NUM_CURVES'    : lambda mod: _num_files(mod.CURVES_FILEPATH),
+    'NUM_EDGES'     : lambda mod: _num_files(mod.EDGE_PATH),
+    'LABELS_INDEX'  : lambda mod: labelindex.from_file(mod.LABELS_FILEPATH),
+    'FINAL_INDEX'   : lambda mod: labelindex.from_file(mod.FINAL_FILEPATH),
+    'LABELS'        : lambda mod: mod.LABELS_INDEX.unique()[0],
+    'SIZES'         : lambda mod: mod.LABELS_INDEX.unique()[1],
+}
+
+
+class _LazySettings(types.ModuleType):
+    """
+    Module type that loads the data-derived settings (masks and their
+    label indices, labels and sizes, spectra classes, file counts) on
+    first attribute access and then keeps them as ordinary module
+    attributes.
+    """
+
+    def __getattr__(self, name):
+
+        if name not in _LAZY:
+            raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, name))
+
+        value = _LAZY[name](self)
+        setattr(self, name, value)
+
+        return value
+
 
-# unique labels, sizes
-LABELS, SIZES = np.unique(LABELS_MASK, return_counts=True)
\ No newline at end of file
+# -- replace this module by its lazy version (keeping a reference to the
+#    original so its globals are not cleared)
+_lazy = _LazySettings(__name__, __doc__)
+_lazy.__dict__.update(sys.modules[__name__].__dict__)
+_lazy._module = sys.modules[__name__]
+sys.modules[__name__] = _lazy
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+
+def bil_spans(shape, rows=None, cols=None, bands=None):
+    """
+    Byte ranges of a region of interest of a Middleton hyperspectral raw
+    file, stored band interleaved by line as (ncol, nwav, nrow) uint16
+    with reversed rows.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the data cube (nwav, nrow, ncol).
+    rows, cols, bands : tuple, optional
+        (start, stop) of the rows, columns and bands of the region (all if
+        None).
+
+    Returns
+    -------
+    offsets : ndarray
+        Byte offset of the span of each (col, band) of the region, columns
+        major.
+    length : int
+        Length of each span in bytes (the rows of the region).
+    """
+
+    nwav, nrow, ncol = shape
+    r0, r1 = (0, nrow) if rows is None else rows
+    c0, c1 = (0, ncol) if cols is None else cols
+    w0, w1 = (0, nwav) if bands is None else bands
+
+    cc = np.arange(c0, c1, dtype=np.int64)[:, np.newaxis]
+    ww = np.arange(w0, w1, dtype=np.int64)[np.newaxis, :]
+
+    offsets = ((cc * nwav + ww) * nrow + nrow - r1) * 2
+
+    return offsets.ravel(), (r1 - r0) * 2
+
+
+def _readinto(f, fpath, arr):
+    """
+    Fill a contiguous array from the current position of f.
+    """
+
+    view  = memoryview(arr.reshape(-1).view(np.uint8))
+    nread = 0
+
+    while nread < arr.nbytes:
+        nn = f.readinto(view[nread:])
+        if not nn:
+            raise IOError("unexpected end of file {0}".format(fpath))
+        nread += nn
+
+
+def _read_runs(fpath, offsets, length, runs, out):
+    """
+    Read runs of spans (start and stop indices into offsets) into the
+    rows of out, one contiguous read per run.
+    """
+
+    nsamp = length // 2
+
+    with io.open(fpath, 'rb', buffering=0) as f:
+        for first, last in runs:
+            start = offsets[first]
+            nbyte = offsets[last - 1] + length - start
+
+            f.seek(start)
+
+            # -- back-to-back spans are read straight into their rows
+            if nbyte == (last - first) * length:
+                _readinto(f, fpath, out[first:last])
+                continue
+
+            buf = np.empty(nbyte // 2, dtype=np.uint16)
+            _readinto(f, fpath, buf)
+
+            idx = (offsets[first:last] - start)[:, np.newaxis] // 2 + np.arange(nsamp)
+            out[first:last] = buf[idx]
+
+
+def read_roi(fpath, shape, rows=None, cols=None, bands=None, max_gap=0, max_run=2**26,
+             nthreads=1):
+    """
+    Read a region of interest of a hyperspectral scan, reading only the
+    byte ranges it covers.
+
+    Each (col, band) of the region is a span of rows on disk, one band
+    stride (nrow * 2 bytes) from the next.  Spans closer than max_gap are
+    merged into a single read, trading bytes read (the gaps) for fewer
+    seeks: the default only merges back-to-back spans (full row windows),
+    so a row window reads just its rows, whereas a max_gap of a band stride
+    or more reads every band of the selected columns in full.
+
+    Parameters
+    ----------
+    fpath : str
+        The name of the raw file.
+    shape : tuple
+        Shape of the data cube (nwav, nrow, ncol).
+    rows, cols, bands : tuple, optional
+        (start, stop) of the rows, columns and bands to read (all if None).
+    max_gap : int, optional
+        Spans separated by at most this many bytes are read together.
+    max_run : int, optional
+        Maximum size (bytes) of a single read.
+    nthreads : int, optional
+        Number of threads reading runs in parallel.
+
+    Returns
+    -------
+    ndarray
+        Contiguous uint16 array of the region (nwav, nrow, ncol), equal to
+        the (nwav, nrow, ncol) memmap of the file sliced by the windows.
+    """
+
+    nwav, nrow, ncol = shape
+    r0, r1 = (0, nrow) if rows is None else rows
+    c0, c1 = (0, ncol) if cols is None else cols
+    w0, w1 = (0, nwav) if bands is None else bands
+
+    offsets, length = bil_spans(shape, (r0, r1), (c0, c1), (w0, w1))
+
+    # -- coalesce spans separated by small gaps, capping the size of a read
+    brk = np.ones(offsets.size, dtype=bool)
+    brk[1:] = offsets[1:] - offsets[:-1] - length > max_gap
+    run = np.cumsum(brk) - 1
+    key = run * (offsets[-1] // max_run + 1) + (offsets - offsets[brk][run]) // max_run
+    brk[1:] |= key[1:] != key[:-1]
+
+    starts = np.flatnonzero(brk)
+    runs   = list(zip(starts, np.append(starts[1:], offsets.size)))
+
+    # -- read each (col, band) span of rows, in parallel if desired
+    spans = np.empty((offsets.size, length // 2), dtype=np.uint16)
+
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(lambda ii: _read_runs(fpath, offsets, length, runs[ii::nthreads], spans),
+                     range(nthreads))
+        finally:
+            pool.close()
+    else:
+        _read_runs(fpath, offsets, length, runs, spans)
+
+    # -- (ncol, nwav, nrow reversed) -> (nwav, nrow, ncol)
+    spans = spans.reshape(c1 - c0, w1 - w0, r1 - r0)[:, :, ::-1]
+
+    return np.ascontiguousarray(spans.transpose(1, 2, 0))
@@ -5,13 +5,168 @@ import os
 import time
 import numpy as np
 import cPickle as pickle
-from scipy.ndimage.filters import gaussian_filter as gf
-from scipy.ndimage import correlate1d
+import events
+import scheduler
 
 # global variables
 DATA_IN = os.path.join(os.environ['REBOUND_WRITE'], 'lightcurves') # location of lightcurves
+NIGHT_MEMORY = 3e9 # estimated peak memory of edge for one night (bytes)
 
-def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_dir=None):
+def clip_stats(gd, msk):
+    """
+    Mean and standard deviation along the first axis of the unmasked
+    elements of gd (0 where a column is fully masked), matching the data of
+    np.ma.array(gd, mask=msk).mean(0) and .std(0).
+    """
+
+    good = ~msk
+    cnt  = good.sum(0)
+    zero = np.zeros(gd.shape[1:], dtype=gd.dtype)
+    avg  = np.divide(np.where(good, gd, 0).sum(0), cnt, out=zero.copy(), where=cnt > 0)
+    anom = np.where(good, gd - avg, 0)
+    sig  = np.sqrt(np.divide((anom * anom).sum(0), cnt, out=zero, where=cnt > 0))
+
+    return avg, sig
+
+
+def sigma_clip(gd, mask, amp, niter=10):
+    """
+    Iteratively sigma clip a gaussian difference array along the first axis
+    on plain arrays, returning the same final mean and standard deviation as
+    the masked-array loop
+
+        for _ in range(niter):
+            gd.mask = np.abs(gd - gd.mean(0)) > amp * gd.std(0)
+
+    Note that in that loop the subtraction leaves masked elements unchanged,
+    so they are compared to the threshold without removing the mean.  The
+    iteration stops early once the mask no longer changes.
+
+    Parameters
+    ----------
+    gd : ndarray
+        Gaussian difference of the lightcurves (nobs x nsources).
+    mask : ndarray
+        Boolean mask of gd (True is masked).
+    amp : float
+        Clipping threshold in units of the standard deviation.
+    niter : int, optional
+        Maximum number of clipping iterations.
+
+    Returns
+    -------
+    avg, sig : ndarray
+        Clipped mean and standard deviation of each source.
+    """
+
+    msk = mask
+
+    for _ in range(niter):
+        avg, sig = clip_stats(gd, msk)
+        new      = np.abs(gd - np.where(msk, 0, avg)) > amp * sig
+
+        # -- an unchanged mask gives unchanged statistics from here on
+        if np.array_equal(new, msk):
+            break
+
+        msk = new
+
+    return clip_stats(gd, msk)
+
+
+def window_stats(lcs, widths):
+    """
+    Absolute difference of the means and maximum standard deviation of the
+    w observations before and after each observation (the left window is
+    [i-w, i), the right [i, i+w), reflected at the ends), computed from
+    cumulative sums so the cost does not depend on w.
+
+    Several widths can be evaluated from the same prefix sums, e.g. to
+    sweep the robustness cross check over w.
+
+    Parameters
+    ----------
+    lcs : ndarray
+        Lightcurves (nobs x nsources).
+    widths : int or list of ints
+        Window width(s) in observations.
+
+    Returns
+    -------
+    lcs_md, lcs_std : ndarray
+        Mean difference and max std across each observation (nobs x
+        nsources); a list of (lcs_md, lcs_std) tuples if widths is a list.
+    """
+
+    single = np.isscalar(widths)
+    widths = [widths] if single else list(widths)
+    wmax   = max(widths)
+    nobs   = lcs.shape[0]
+
+    # -- center the curves to limit round-off in the running sums
+    cen = lcs - lcs.mean(0)
+    pad = np.pad(cen, [(wmax, wmax)] + [(0, 0)] * (lcs.ndim - 1), mode='symmetric')
+
+    cs1 = np.zeros((pad.shape[0] + 1,) + pad.shape[1:])
+    cs2 = np.zeros((pad.shape[0] + 1,) + pad.shape[1:])
+    np.cumsum(pad, axis=0, out=cs1[1:])
+    np.cumsum(pad * pad, axis=0, out=cs2[1:])
+
+    out = []
+
+    for w in widths:
+        lo  = slice(wmax - w, wmax - w + nobs)
+        cur = slice(wmax, wmax + nobs)
+        hi  = slice(wmax + w, wmax + w + nobs)
+
+        sum_l = cs1[cur] - cs1[lo]
+        sum_r = cs1[hi] - cs1[cur]
+        var_l = (cs2[cur] - cs2[lo]) / float(w) - (sum_l / float(w))**2
+        var_r = (cs2[hi] - cs2[cur]) / float(w) - (sum_r / float(w))**2
+
+        out.append((np.abs(sum_r - sum_l) / float(w), np.sqrt(np.maximum(var_l, var_r))))
+
+    return out[0] if single else out
+
+
+def window_stats_at(lcs, rows, cols, width):
+    """
+    Same statistics as window_stats for a single width, evaluated only at
+    the (row, col) positions given, by gathering each position's 2*width
+    window (reflected at the ends).
+
+    Parameters
+    ----------
+    lcs : ndarray
+        Lightcurves (nobs x nsources).
+    rows, cols : ndarray
+        Observation and source indices of the positions.
+    width : int
+        Window width in observations.
+
+    Returns
+    -------
+    md, std : ndarray
+        Mean difference and max std across each position.
+    """
+
+    nobs = lcs.shape[0]
+
+    # -- reflected window indices (d c b a | a b c d | d c b a)
+    win = (rows[:, np.newaxis] + np.arange(-width, width)) % (2 * nobs)
+    win = np.where(win >= nobs, 2 * nobs - 1 - win, win)
+    vals = lcs[win, cols[:, np.newaxis]]
+
+    mean_l = vals[:, :width].mean(1)
+    mean_r = vals[:, width:].mean(1)
+    var_l  = (vals[:, :width]**2).mean(1) - mean_l**2
+    var_r  = (vals[:, width:]**2).mean(1) - mean_r**2
+
+    return np.abs(mean_r - mean_l), np.sqrt(np.maximum(var_l, var_r))
+
+
+def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_dir=None,
+         sparse_xcheck=True):
     """
     Detect the on/off transitions for lightcurves and write to a file.
 
@@ -23,6 +178,10 @@ def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_di
     output_dir : str (default None)
         Filepath to save on/off indices too; returns object if None
 
+    sparse_xcheck : bool (default True)
+        Evaluate the left/right window cross check only at the candidate
+        extrema rather than at every observation
+
     Returns:
     --------
     Object with attributes:
@@ -32,8 +191,9 @@ def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_di
         .offs = 2-d array of indices of changes to "off" state (nobs x nsources)
         .tstamps = vector indices of naive Unix timestamp (int)
 
-    If output_dir is set, these data structures will be saves as an 5-tuple in this order:
-    lcs, gd, ons, offs, tstamps
+    If output_dir is set, the ons and offs are saved as a sparse event table
+    (edge_events_MM_DD.npz, see events.EdgeEvents) that references the
+    lightcurve file rather than duplicating it.
     """
     start = time.time()
     # -- utilities
@@ -48,34 +208,15 @@ def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_di
     with open(os.path.join(DATA_IN, curve), 'rb') as file:
         lcs, tstamps = pickle.load(file)
 
-    # -- generate a mask
+    # -- compute the masked gaussian difference
     print("generating mask for {} {}...".format(month,night))
-    msk = gf((lcs > -9999).astype(float), (width, 0)) > 0.9999
-    
-    # -- convert to smooth the lightcurves (taking into account the mask)
-    msk_sm = gf(msk.astype(float), (width, 0))
-    lcs_sm = gf(lcs * msk, (width, 0)) / (msk_sm + (msk_sm == 0))
-    
-    # -- compute the gaussian difference (using a masked array now)
-    lcs_gd = np.ma.zeros(lcs_sm.shape, dtype=lcs_sm.dtype)
-    lcs_gd[delta // 2: -delta // 2] = lcs_sm[delta:] - lcs_sm[:-delta]
-    
-    # -- set the gaussian difference mask
-    lcs_gd.mask = np.zeros_like(msk)
-    lcs_gd.mask[delta // 2: -delta // 2] = ~(msk[delta:] * msk[:-delta])
+    lcs_gd = events.gauss_diff(lcs, width, delta)
     
     time_clip = time.time()
 
     # -- sigma clip and reset the means, standard deviations, and masks
     print("sigma clipping ...")
-    tmsk = lcs_gd.mask.copy()
-    for _ in range(10):
-        avg             = lcs_gd.mean(0)
-        sig             = lcs_gd.std(0)
-        lcs_gd.mask = np.abs(lcs_gd - avg) > sig_clip_amp * sig
-    final_avg = lcs_gd.mean(0).data
-    final_sig = lcs_gd.std(0).data
-    lcs_gd.mask = tmsk
+    final_avg, final_sig = sigma_clip(lcs_gd.data, lcs_gd.mask, sig_clip_amp)
     
     # -- tag the potential ons and offs
     tags_on  = np.zeros(lcs_gd.shape, dtype=bool)
@@ -97,26 +238,23 @@ def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_di
     print('Time to find max on/off: {}'.format(time_extrema-time_clip))
 
     # -- cross check left/right means for robustness to noise
-    print("setting up filters...")
-    mean_diff  = ((np.arange(2 * width) >= width) * 2 - 1) / float(width)
-    mean_left  = 1.0 * (np.arange(2 * width) < width) / float(width)
-    mean_right = 1.0 * (np.arange(2 * width) >= width) / float(width)
-    
-    # calculate mean difference across transition
-    lcs_md     = np.abs(correlate1d(lcs, mean_diff, axis=0))
-    
-    # calculate max std across transition
-    lcs_sq     = lcs**2
-    lcs_std    = np.sqrt(np.maximum(correlate1d(lcs_sq, mean_left, axis=0) - 
-                                    correlate1d(lcs, mean_left, axis=0)**2, 
-                                    correlate1d(lcs_sq, mean_right, axis=0) - 
-                                    correlate1d(lcs, mean_right, axis=0)**2))
+    print("computing window statistics...")
+    if sparse_xcheck:
+        rows, cols        = np.nonzero(tags_on | tags_off)
+        cand_md, cand_std = window_stats_at(lcs, rows, cols, width)
+    else:
+        lcs_md, lcs_std = window_stats(lcs, width)
     
     time_cor = time.time()
     print('Time to correlate: {}'.format(time_cor-time_extrema))
 
     # -- identify all potentially robust transitions and prune list
-    good_arr  = lcs_md > sig_xcheck * lcs_std
+    if sparse_xcheck:
+        good     = cand_md > sig_xcheck * cand_std
+        good_arr = np.zeros(lcs.shape, dtype=bool)
+        good_arr[rows[good], cols[good]] = True
+    else:
+        good_arr = lcs_md > sig_xcheck * lcs_std
 
     pad       = np.zeros((lcs.shape), dtype=bool)
     good_ons  = (pad + tags_on) & good_arr
@@ -135,26 +273,40 @@ def edge(curve, w=30, s_peaks = 0.0, s_clip_amp = 2.0, s_xcheck = 2.0, output_di
         return output(lcs, lcs_gd, good_ons, good_offs, tstamps)
 
     else:
-        with open(os.path.join(output_dir, 'edge_obj_{}_{}.pkl'.format(month, night)), 'wb') as o:
-            edge_obj = lcs, lcs_gd, good_ons, good_offs, tstamps
-            pickle.dump(edge_obj, o, pickle.HIGHEST_PROTOCOL)
+        # -- write a sparse event table that references the lightcurves
+        evts = events.from_dense(good_ons, good_offs, lcs_gd, tstamps,
+                                 curves=os.path.join(DATA_IN, curve), width=width, delta=delta)
+        evts.save(os.path.join(output_dir, 'edge_events_{}_{}.npz'.format(month, night)))
 
     end = time.time()
     print "Total runtime: {}".format(end - start)
 
 
-def multi_nights(output_dir, all_nights=False, nights=None):
+def edge_night(night, output_dir):
+    """
+    Run edge for an "MM_DD" night (worker for multi_nights).
+    """
+
+    edge(curve='lightcurves_and_tstamps_tuple_{}.pkl'.format(night), output_dir=output_dir)
+
+
+def multi_nights(output_dir, all_nights=False, nights=None, nproc=None, mem_budget=None,
+                 manifest=None, retries=1):
     """
     Nights input is str or list of strs, formated as: "07_01"  etc
+
+    Nights are run in parallel on a process pool capped by mem_budget (bytes,
+    each night is assumed to need NIGHT_MEMORY).  If manifest is set,
+    finished nights are recorded in that JSON file and skipped on reruns,
+    and nights that keep failing are quarantined there.
     """
 
-    start_all = time.time()
     if all_nights:
-        for lc in os.listdir(DATA_IN):
-            edge(curve=lc, output_dir=output_dir)
+        nights = ['_'.join(lc.split('.')[0].split('_')[-2:]) for lc in sorted(os.listdir(DATA_IN))]
 
-    else:
-        for n in nights:
-            edge(curve='lightcurves_and_tstamps_tuple_{}.pkl'.format(n),output_dir=output_dir)
-            
-    print "Total runtime for all nights: {}".format(time.time() - start_all)
\ No newline at end of file
+    elif isinstance(nights, basestring):
+        nights = [nights]
+
+    return scheduler.run_nights(edge_night, nights, manifest=manifest, nproc=nproc,
+                                mem_budget=mem_budget, mem_per_night=NIGHT_MEMORY,
+                                retries=retries, output_dir=output_dir)
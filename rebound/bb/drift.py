@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import bb_settings
+import manifest
+
+
+def downsample(img, fac):
+    """
+    Block average of an image by an integer factor (an even factor also
+    averages out the Bayer pattern of the raw images).
+    """
+
+    nr, nc = img.shape[0] // fac, img.shape[1] // fac
+    rows   = img[:nr * fac, :nc * fac].reshape(nr, fac, nc * fac).sum(1, dtype=np.float32)
+
+    return rows.reshape(nr, nc, fac).sum(2) / fac**2
+
+
+def _peak(corr):
+    """
+    Subpixel position of the maximum of a (circular) phase correlation
+    surface, as signed offsets, from the ratio of the peak to its larger
+    neighbour along each axis (Foroosh et al. 2002).
+    """
+
+    ir, ic = np.unravel_index(corr.argmax(), corr.shape)
+    off    = []
+
+    for ii, nn, line in ((ir, corr.shape[0], corr[:, ic]), (ic, corr.shape[1], corr[ir])):
+        mid  = line[ii]
+        sgn  = 1 if line[(ii + 1) % nn] >= line[(ii - 1) % nn] else -1
+        side = line[(ii + sgn) % nn]
+        sub  = 0.
+
+        for den in (side + mid, side - mid):
+            if den != 0 and 0 <= side / den <= 1:
+                sub = sgn * side / den
+                break
+
+        pos = ii + sub
+        off.append(pos - nn if pos > nn / 2. else pos)
+
+    return off
+
+
+class DriftTracker(object):
+    """
+    Frame-to-reference translation and small rotation from phase
+    correlation of downsampled, Hann-windowed images.
+
+    The translation is measured separately on the left and right halves
+    of the image; their mean is the shift of the image center and their
+    difference in rows gives the rotation.
+
+    Parameters
+    ----------
+    ref : ndarray
+        Reference image (nrows x ncols).
+    fac : int, optional
+        Downsampling factor.
+
+    Attributes
+    ----------
+    halves : list
+        Conjugate FFTs of the windowed reference halves.
+    """
+
+    def __init__(self, ref, fac=4):
+
+        self.fac   = fac
+        self.shape = ref.shape[:2]
+
+        small = downsample(ref, fac)
+        half  = small.shape[1] // 2
+
+        self.window = np.outer(np.hanning(small.shape[0]), np.hanning(half)).astype(np.float32)
+        self.halves = [np.fft.rfft2(self._prep(small[:, :half])).conj(),
+                       np.fft.rfft2(self._prep(small[:, half:2 * half])).conj()]
+
+    def _prep(self, img):
+        return (img - img.mean()) * self.window
+
+    def measure(self, img):
+        """
+        Drift of an image relative to the reference.
+
+        Parameters
+        ----------
+        img : ndarray
+            Image (nrows x ncols).
+
+        Returns
+        -------
+        ndarray
+            Row and column shift (full resolution pixels) and rotation
+            (degrees, positive when the right half moves to larger rows);
+            img[r + dr, c + dc] ~ ref[r, c].
+        """
+
+        small = downsample(img, self.fac)
+        half  = small.shape[1] // 2
+        offs  = []
+
+        for ii, rfft in enumerate(self.halves):
+            cross = np.fft.rfft2(self._prep(small[:, ii * half:(ii + 1) * half])) * rfft
+            cross /= np.abs(cross) + 1e-12
+            offs.append(_peak(np.fft.irfft2(cross, self.window.shape)))
+
+        (drl, dcl), (drr, dcr) = offs
+        dr, dc = 0.5 * (drl + drr) * self.fac, 0.5 * (dcl + dcr) * self.fac
+        dtheta = np.arctan2((drr - drl) * self.fac, half * self.fac) * 180. / np.pi
+
+        return np.array([dr, dc, dtheta])
+
+
+def _read(fname, sh=bb_settings.IMG_SHAPE):
+    return np.fromfile(fname, dtype=np.uint8).reshape(sh[0], sh[1])
+
+
+def reference(paths, nref=5):
+    """
+    Nightly reference image, the median of nref frames around the middle
+    of a list of raw files.
+    """
+
+    mid = len(paths) // 2
+    sel = paths[max(mid - nref // 2, 0):mid - nref // 2 + nref]
+
+    return np.median([_read(i) for i in sel], 0).astype(np.float32)
+
+
+def track(paths, ref, fac=4, nthreads=None, chunk=64):
+    """
+    Drift of a list of raw frames relative to a reference image, measured
+    in a thread pool.
+
+    Parameters
+    ----------
+    paths : list
+        Raw files.
+    ref : ndarray
+        Reference image.
+    fac : int, optional
+        Downsampling factor.
+    nthreads : int, optional
+        Number of threads (default number of cpus).
+    chunk : int, optional
+        Number of frames handed to a thread at once.
+
+    Returns
+    -------
+    ndarray
+        Row shift, column shift and rotation of each frame (nframes x 3).
+    """
+
+    tracker = DriftTracker(ref, fac)
+    pool    = ThreadPool(multiprocessing.cpu_count() if nthreads is None else nthreads)
+
+    try:
+        out = pool.map(lambda i: tracker.measure(_read(i)), paths, chunksize=chunk)
+    finally:
+        pool.close()
+
+    return np.array(out).reshape(-1, 3)
+
+
+def night_drift(month, night, fac=4, nref=5, nthreads=None, refresh=False):
+    """
+    Drift of every frame of a night relative to its nightly reference,
+    cached next to the night's manifest and reused until the night
+    directory changes.
+
+    Parameters
+    ----------
+    month, night : str
+        Month and night directories of the raw images.
+    fac : int, optional
+        Downsampling factor.
+    nref : int, optional
+        Number of frames in the reference (see reference).
+    nthreads : int, optional
+        Number of threads.
+    refresh : bool, optional
+        Force remeasurement.
+
+    Returns
+    -------
+    ndarray
+        Row shift, column shift and rotation of each frame (nframes x 3).
+    """
+
+    data_dir = os.path.join(bb_settings.DATA_FILEPATH, month, night)
+    man      = manifest.scan(data_dir)
+    cfile    = manifest.cache_file(data_dir, 'drift')
+
+    if not refresh and os.path.isfile(cfile):
+        npz = np.load(cfile)
+
+        if float(npz['dir_mtime']) == man.dir_mtime and tuple(npz['params']) == (fac, nref):
+            return npz['drift']
+
+    paths = man.paths()
+    drift = track(paths, reference(paths, nref), fac, nthreads)
+
+    with open(cfile + '.tmp', 'wb') as f:
+        np.savez(f, dir_mtime=man.dir_mtime, params=(fac, nref), drift=drift)
+
+    os.rename(cfile + '.tmp', cfile)
+
+    return drift
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import nightly
 
 
 def calc_dur(ons, offs):
@@ -10,34 +11,9 @@ def calc_dur(ons, offs):
     Their shape: (num nights x num timesteps x num sources)
     Returns a 2-d array of duration for light curves (each source for each night),
     shape (num nights x num sources)
-    """
-    ons *= 1.0
-    offs *= -1.0
-
-    master = ons + offs
-
-    # calculate duration
-    dur = np.zeros((master.shape[0], master.shape[-1]))
-    last_idx = np.zeros((master.shape[0], master.shape[-1]))
-    last_on = np.zeros((master.shape[0], master.shape[-1]), dtype=bool)
 
-    for i in range(master.shape[1]):
-
-        # if on
-        on_msk = (master[:, i, :] == 1) & (~last_on)
-        try:
-            last_idx[on_msk] = i
-            last_on[on_msk] = True
-        except ValueError:
-            pass
-
-        # if off
-        off_msk = master[:, i, :] == -1
-        try:
-            dur[off_msk] += (i - last_idx[off_msk])
-            last_on[off_msk] = False
-            last_idx[off_msk] = i
-        except ValueError:
-            pass
+    Computed in one pass over the transitions by nightly.from_dense, which also
+    gives first on, last off, number of transitions and longest on period.
+    """
 
-    return dur
+    return nightly.from_dense(ons, offs).duration
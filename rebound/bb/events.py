@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import cPickle as pickle
+from scipy.ndimage.filters import gaussian_filter as gf
+
+# -- event types
+ON  = 1
+OFF = -1
+
+
+def gauss_diff(lcs, width=30, delta=2):
+    """
+    Gaussian difference of lightcurves, masked where the smoothing window
+    overlaps missing (-99999) observations.
+
+    Parameters
+    ----------
+    lcs : ndarray
+        Lightcurves (nobs x nsources).
+    width : int, optional
+        Width of the Gaussian filter (in observations).
+    delta : int, optional
+        Offset of the difference (in observations).
+
+    Returns
+    -------
+    masked array
+        Gaussian difference (nobs x nsources).
+    """
+
+    # -- generate a mask
+    msk = gf((lcs > -9999).astype(float), (width, 0)) > 0.9999
+
+    # -- convert to smooth the lightcurves (taking into account the mask)
+    msk_sm = gf(msk.astype(float), (width, 0))
+    lcs_sm = gf(lcs * msk, (width, 0)) / (msk_sm + (msk_sm == 0))
+
+    # -- compute the gaussian difference (using a masked array now)
+    lcs_gd = np.ma.zeros(lcs_sm.shape, dtype=lcs_sm.dtype)
+    lcs_gd[delta // 2: -delta // 2] = lcs_sm[delta:] - lcs_sm[:-delta]
+
+    # -- set the gaussian difference mask
+    lcs_gd.mask = np.zeros_like(msk)
+    lcs_gd.mask[delta // 2: -delta // 2] = ~(msk[delta:] * msk[:-delta])
+
+    return lcs_gd
+
+
+class EdgeEvents(object):
+    """
+    Sparse table of the on/off transitions of a night, one row per event,
+    replacing the dense (nobs x nsources) boolean arrays of edge.
+
+    Attributes
+    ----------
+    src : ndarray
+        Source (column) index of each event.
+    idx : ndarray
+        Observation (frame) index of each event.
+    tstamp : ndarray
+        Naive Unix timestamp of each event.
+    kind : ndarray
+        Event type, ON (1) or OFF (-1).
+    strength : ndarray
+        Gaussian difference at the event.
+    tstamps : ndarray
+        Timestamps of all observations of the night (nobs).
+    nsrc : int
+        Number of sources.
+    curves : str
+        Path of the night's lightcurve pickle (lcs, tstamps) or lcstore
+        curves_MM_DD.npy, or None.
+    width, delta : int
+        Gaussian difference parameters used for detection.
+    """
+
+    def __init__(self, src, idx, tstamp, kind, strength, tstamps, nsrc, curves=None,
+                 width=30, delta=2):
+
+        self.src      = src
+        self.idx      = idx
+        self.tstamp   = tstamp
+        self.kind     = kind
+        self.strength = strength
+        self.tstamps  = tstamps
+        self.nsrc     = int(nsrc)
+        self.curves   = curves
+        self.width    = int(width)
+        self.delta    = int(delta)
+
+    def __len__(self):
+        return len(self.src)
+
+    @property
+    def nobs(self):
+        return len(self.tstamps)
+
+    def subset(self, sources):
+        """
+        Events of a subset of sources (source indices are kept).
+        """
+
+        keep = np.in1d(self.src, sources)
+
+        return EdgeEvents(self.src[keep], self.idx[keep], self.tstamp[keep], self.kind[keep],
+                          self.strength[keep], self.tstamps, self.nsrc, self.curves,
+                          self.width, self.delta)
+
+    def _select(self, kind, sources=None):
+        """
+        Events of a type, with sources remapped to positions in sources.
+        """
+
+        sel = self.kind == kind
+        src = self.src[sel]
+        idx = self.idx[sel]
+
+        if sources is not None:
+            pos = np.full(self.nsrc, -1, dtype=np.int64)
+            pos[sources] = np.arange(len(sources))
+            src = pos[src]
+            idx = idx[src >= 0]
+            src = src[src >= 0]
+
+        return src, idx
+
+    def dense(self, kind, sources=None):
+        """
+        Rebuild a dense (nobs x nsources) boolean array of one event type.
+
+        Parameters
+        ----------
+        kind : int
+            ON or OFF.
+        sources : array-like, optional
+            Source indices (columns) to include; all if None.
+
+        Returns
+        -------
+        ndarray
+            True at each event.
+        """
+
+        src, idx = self._select(kind, sources)
+        nsrc     = self.nsrc if sources is None else len(sources)
+        out      = np.zeros((self.nobs, nsrc), dtype=bool)
+        out[idx, src] = True
+
+        return out
+
+    def last(self, kind, sources=None):
+        """
+        Index of the last event of a type for each source (-1 if none).
+        """
+
+        src, idx = self._select(kind, sources)
+        out      = np.full(self.nsrc if sources is None else len(sources), -1, dtype=np.int64)
+        np.maximum.at(out, src, idx)
+
+        return out
+
+    def load_curves(self):
+        """
+        Read the referenced lightcurves (nobs x nsources), either a
+        lightcurve pickle or a (source-major) lcstore array.
+        """
+
+        if self.curves.endswith('.npy'):
+            return np.load(self.curves).T
+
+        with open(self.curves, 'rb') as file:
+            lcs, _ = pickle.load(file)
+
+        return lcs
+
+    def gd(self, lcs=None):
+        """
+        Recompute the Gaussian difference from the (referenced) lightcurves.
+        """
+
+        if lcs is None:
+            lcs = self.load_curves()
+
+        return gauss_diff(lcs, self.width, self.delta)
+
+    def save(self, fname):
+        """
+        Write the table as an .npz file of columns.
+        """
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, src=self.src, idx=self.idx, tstamp=self.tstamp, kind=self.kind,
+                     strength=self.strength, tstamps=self.tstamps, nsrc=self.nsrc,
+                     curves='' if self.curves is None else self.curves,
+                     width=self.width, delta=self.delta)
+
+        os.rename(fname + '.tmp', fname)
+
+
+def from_dense(ons, offs, gd, tstamps, curves=None, width=30, delta=2):
+    """
+    Build an EdgeEvents table from dense on/off arrays.
+
+    Parameters
+    ----------
+    ons, offs : ndarray
+        Boolean arrays of on/off transitions (nobs x nsources).
+    gd : ndarray
+        Gaussian difference of the lightcurves (nobs x nsources).
+    tstamps : ndarray
+        Timestamps of the observations (nobs).
+    curves : str, optional
+        Path of the night's lightcurve pickle.
+    width, delta : int, optional
+        Gaussian difference parameters used for detection.
+
+    Returns
+    -------
+    EdgeEvents
+        The event table, sorted by observation then source.
+    """
+
+    tstamps  = np.asarray(tstamps)
+    gd       = np.ma.getdata(gd)
+    on_idx, on_src   = np.nonzero(ons)
+    off_idx, off_src = np.nonzero(offs)
+
+    idx  = np.concatenate([on_idx, off_idx]).astype(np.int32)
+    src  = np.concatenate([on_src, off_src]).astype(np.int32)
+    kind = np.concatenate([np.full(on_idx.size, ON, dtype=np.int8),
+                           np.full(off_idx.size, OFF, dtype=np.int8)])
+
+    order = np.lexsort((src, idx))
+    idx, src, kind = idx[order], src[order], kind[order]
+
+    return EdgeEvents(src, idx, tstamps[idx], kind, gd[idx, src].astype(np.float32),
+                      tstamps, ons.shape[1], curves, width, delta)
+
+
+def load(fname):
+    """
+    Read an EdgeEvents table written by EdgeEvents.save.
+    """
+
+    npz    = np.load(fname)
+    curves = str(npz['curves'])
+
+    return EdgeEvents(npz['src'], npz['idx'], npz['tstamp'], npz['kind'], npz['strength'],
+                      npz['tstamps'], int(npz['nsrc']), curves if curves else None,
+                      int(npz['width']), int(npz['delta']))
+
+
+def load_edges(fname):
+    """
+    Read a night's edges as (lcs, gd, ons, offs, tstamps) from either an
+    event table (.npz) or a legacy dense edge pickle.
+    """
+
+    if fname.endswith('.npz'):
+        ev  = load(fname)
+        lcs = ev.load_curves()
+
+        return lcs, ev.gd(lcs), ev.dense(ON), ev.dense(OFF), ev.tstamps
+
+    with open(fname, 'rb') as file:
+        return pickle.load(file)
+
+
+def load_onoff(fname):
+    """
+    Read only a night's (ons, offs, tstamps) from either an event table
+    (.npz, without touching the lightcurves) or a legacy dense edge pickle.
+    """
+
+    if fname.endswith('.npz'):
+        ev = load(fname)
+
+        return ev.dense(ON), ev.dense(OFF), ev.tstamps
+
+    with open(fname, 'rb') as file:
+        _, _, ons, offs, tstamps = pickle.load(file)
+
+    return ons, offs, tstamps
@@ -4,9 +4,11 @@
 import os
 import numpy as np
 import pandas as pd
+import matplotlib.pyplot as plt
+import hsimap
+import labelindex
 from utils import read_raw
 from hsi_utils import read_hyper
-import scipy.ndimage.measurements as spm
 
 
 # -- read images
@@ -23,96 +25,14 @@ except:
     bb_mask = np.load(bb_mask)
     bb_labels = np.load(bb_labels)
 
-# -- read sources
+# -- fit the BB -> HSI solution to the sources and persist it (with its
+#    lookup tables)
 sname = os.path.join(os.environ["REBOUND_WRITE"], "sources.csv")
 srcs  = pd.read_csv(sname)
+bbmap = hsimap.fit(img_hs.shape, sname, img_bb.shape[:2])
+bbmap.save()
 
-
-# -- extract positions
-rrr0, ccc0 = srcs.hs_r.values.copy(), srcs.hs_c.values.copy()
-rrr1, ccc1 = srcs.bb_r.values.copy(), srcs.bb_c.values.copy()
-
-
-# -- correct for the aspect ratio of the HSI pixels
-asp0   = 0
-asp1   = 2
-rat_bb = (rrr1[asp0] - rrr1[asp1]) / (ccc1[asp1] - ccc1[asp0])
-rat_hs = (rrr0[asp1] - rrr0[asp0]) / (ccc0[asp0] - ccc0[asp1])
-fac_hs =  rat_bb / rat_hs
-
-print("HSI aspect ratio = {0}".format(fac_hs))
-    
-ccc0 /= fac_hs
-
-
-# -- get the mean scaling factor between distances
-dist_hs = np.sqrt((rrr0[:, np.newaxis] - rrr0)**2 + 
-                  (ccc0[:, np.newaxis] - ccc0)**2)
-dist_bb = np.sqrt((rrr1[:, np.newaxis] - rrr1)**2 + 
-                  (ccc1[:, np.newaxis] - ccc1)**2)
-factor  = (dist_bb[dist_bb > 0]/dist_hs[dist_bb>0]).mean()
-
-
-# -- fit registration solution
-roff_hsi = img_hs.shape[0] / 2
-coff_hsi = img_hs.shape[1] / 2 / fac_hs
-roff_bb  = img_bb.shape[0] / 2
-coff_bb  = img_bb.shape[1] / 2
-
-rrr0 -= roff_hsi
-ccc0 -= coff_hsi
-rrr1 -= roff_bb
-ccc1 -= coff_bb
-
-rrr1 /= factor
-ccc1 /= factor
-
-
-# -- get the matrix for catalog sources
-mones      = np.zeros(rrr0.size * 2 + 1)
-mones[::2] = 1.0
-
-pm         = np.zeros([rrr0.size * 2, 4])
-pm[::2,0]  = rrr0
-pm[1::2,0] = ccc0
-pm[::2,1]  = -ccc0
-pm[1::2,1] = rrr0
-pm[:,2]    = mones[:-1]
-pm[:,3]    = mones[1:]
-
-
-# -- get the matrix for image sources
-bv         = np.zeros([rrr0.size * 2])
-bv[::2]    = rrr1
-bv[1::2]   = ccc1
-
-
-# -- calculating rotation of image 
-pmTpm = np.dot(pm.T, pm)
-av    = np.dot(np.linalg.inv(pmTpm), np.dot(pm.T, bv))
-
-dr, dc = av[-2:]
-dtheta = np.arctan2(av[1], av[0]) * 180. / np.pi
-
-
-# -- convert all bb row and col indices to hsi indices
-nrow = img_bb.shape[0]
-ncol = img_bb.shape[1]
-rind = np.arange(nrow * ncol).reshape(nrow, ncol) // ncol
-cind = np.arange(nrow * ncol).reshape(nrow, ncol) % ncol
-
-rrv  = (rind - roff_bb).astype(float)
-ccv  = (cind - coff_bb).astype(float)
-rrv /= factor
-ccv /= factor
-
-rt_hsi = (rrv * np.cos(-dtheta * np.pi / 180.) -
-           ccv * np.sin(-dtheta * np.pi / 180.) - dr + roff_hsi) \
-           .round().astype(int)
-
-ct_hsi = ((rrv * np.sin(-dtheta * np.pi / 180.) +
-           ccv * np.cos(-dtheta * np.pi / 180.) - dc + coff_hsi) * fac_hs) \
-           .round().astype(int)
+print("HSI aspect ratio = {0}".format(bbmap.params["fac_hs"]))
 
 
 # -- plot the result
@@ -120,7 +40,7 @@ xs = 8.0
 ys = xs * float(img_hs.shape[0]) / float(img_hs.shape[1])
 rgb = np.zeros(list(img_hs.shape) + [3], dtype=np.uint8)
 rgb[..., 0] = (15.0*(1.0*img_hs - 150)).clip(0, 200).astype(np.uint8)
-rgb[rt_hsi, ct_hsi, 2] = (10.*img_bb[rind, cind]).clip(0, 255).astype(np.uint8)
+rgb[..., 2] = (10.*bbmap.image_to_hsi(img_bb)).clip(0, 255).astype(np.uint8)
 
 fig, ax = plt.subplots(figsize=(xs, ys))
 fig.subplots_adjust(0, 0, 1, 1)
@@ -130,18 +50,7 @@ fig.canvas.draw()
 
 
 # -- print the input hsi source locations and the derived
-rrrt = srcs.bb_r.values
-ccct = srcs.bb_c.values
-
-rrv  = (rrrt - roff_bb).astype(float)
-ccv  = (ccct - coff_bb).astype(float)
-rrv /= factor
-ccv /= factor
-
-rv_hsi = (rrv * np.cos(-dtheta * np.pi / 180.) -
-           ccv * np.sin(-dtheta * np.pi / 180.) - dr + roff_hsi)
-cv_hsi = (rrv * np.sin(-dtheta * np.pi / 180.) +
-          ccv * np.cos(-dtheta * np.pi / 180.) - dc + coff_hsi) * fac_hs
+rv_hsi, cv_hsi = bbmap.to_hsi(srcs.bb_r.values, srcs.bb_c.values)
 
 print("HSI_r in  = {0}\nHSI_r out = {1}".format(srcs.hs_r.values, rv_hsi))
 print("")
@@ -149,15 +58,11 @@ print("HSI_c in  = {0}\nHSI_c out = {1}".format(srcs.hs_c.values, cv_hsi))
 
 
 # -- getting the HSI mask
-# -- getting the size of sources
-lsz = spm.sum(bb_mask, bb_labels, range(1, bb_labels.max()+1)) 
-
-for ii in range(lsz.size):
-    if lsz[ii] < 20:
-        bb_labels[bb_labels == ii + 1] = 0
+# -- remove sources smaller than 20 pixels
+bb_index  = labelindex.from_mask(bb_labels).filter(min_size=20)
+bb_labels = bb_index.mask(bb_labels.dtype)
 
-hsi_mask = np.zeros(list(img_hs.shape), dtype=int)
-hsi_mask[rt_hsi, ct_hsi] = bb_labels[rind, cind]
+hsi_mask = bbmap.labels_to_hsi(bb_labels)
 
 fig, ax = plt.subplots(figsize=(xs, ys))
 fig.subplots_adjust(0, 0, 1, 1)
@@ -165,5 +70,5 @@ ax.axis("off")
 im = ax.imshow(hsi_mask)
 fig.canvas.draw()
 
-print len(np.unique(hsi_mask))
-print len(np.unique(bb_labels))
+print len(labelindex.from_mask(hsi_mask).unique()[0])
+print len(bb_index.unique()[0])
@@ -8,6 +8,11 @@ import cPickle as pickle
 import matplotlib.pyplot as plt
 import srcex
 import bb_settings
+import aggregate
+import drift
+import scheduler
+import lcstore
+import manifest
 from datetime import datetime
 from dateutil import tz
 from scipy.ndimage.filters import gaussian_filter as gf
@@ -21,8 +26,62 @@ from scipy.ndimage import measurements as mm
 # LABELS = np.load(os.path.join(
 #     os.environ['REBOUND_WRITE'], 'final', 'labels.npy'))
 
+# estimated peak memory of get_curves for one night (bytes)
+NIGHT_MEMORY = 2e9
 
-def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, create_ts_cube=False):
+
+def read_frames(month, night, file_start=0, file_stop=2700, step=1, chunk=8):
+    '''
+    Generator that reads the raw images of a night in blocks of at most
+    chunk frames, so that only a small, fixed window of the night is ever
+    held in memory.
+
+    Parameters:
+    -----------
+    month : str
+        Month directory of selected night
+
+    night : str
+        Night directory of selected broadband images
+
+    file_start, file_stop, step : int
+        Slice of the sorted raw files to read (as in get_curves)
+
+    chunk : int (default 8)
+        Maximum number of frames held in memory at once
+
+    Yields:
+    -------
+    2-tuple of:
+        1. list of timestamps (integers of naive Unix timestamp) of the block
+        2. view of the float32 frame buffer (nframes x nrows x ncols)
+    '''
+    man = manifest.scan(os.path.join(bb_settings.DATA_FILEPATH, month, night))
+
+    buf = np.empty((chunk, bb_settings.IMG_SHAPE[0], bb_settings.IMG_SHAPE[1]), dtype=np.float32)
+
+    nbuf = 0
+    tstep = []
+
+    for fname, ts in zip(man.paths(file_start, file_stop, step), man.tstamps(file_start, file_stop, step)):
+        tstep.append(int(ts))
+
+        data = np.memmap(fname, dtype=np.uint8, mode='r')
+
+        buf[nbuf, :, :] = data.reshape(bb_settings.IMG_SHAPE[0], bb_settings.IMG_SHAPE[1])
+
+        nbuf += 1
+
+        if nbuf == chunk:
+            yield tstep, buf
+            nbuf = 0
+            tstep = []
+
+    if nbuf > 0:
+        yield tstep, buf[:nbuf]
+
+
+def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, create_ts_cube=False, chunk=8, store=None, daylight=False, track_drift=False):
     '''    
     Averages the luminosity among pixels of each light source
     to produce lightcurve for each source.
@@ -53,6 +112,24 @@ def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, c
         When True, the method will broadcast the 2-d array of lightcurves into a datacube that has the light
         source coordinates in the original image (nobs x nrows x ncols)
 
+    chunk : int (default 8)
+        Number of raw images held in memory at once; images are read one at a time
+        and reduced into per-source means, so memory does not grow with the night
+
+    store : str (default None)
+        If set, path of a lcstore.LightcurveStore (e.g. bb_settings.STORE_PATH) to which
+        the night's lightcurves are also appended
+
+    daylight : bool (default False)
+        If True, file_start and file_stop are replaced by srcex.daylight_bounds(), i.e. the
+        dark part of the night from its cached brightness profile (the lightcurves are then
+        no longer of fixed length)
+
+    track_drift : bool (default False)
+        If True, the label pixels of each frame are offset by the frame's (rounded)
+        translation from drift.night_drift() rather than assuming that all frames are
+        aligned with the labels mask
+
     Returns:
     --------
     If output_dir is None:
@@ -66,53 +143,56 @@ def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, c
     t0 = time.time()
 
     # utilities
-    lnight = len(np.arange(file_start, file_stop, step))
+    if daylight:
+        file_start, file_stop = srcex.daylight_bounds(os.path.join(bb_settings.DATA_FILEPATH, month, night))
 
-    img_cube = np.empty((lnight, bb_settings.IMG_SHAPE[0], bb_settings.IMG_SHAPE[1]), dtype=np.float32)
+    agg = aggregate.from_file(bb_settings.LABELS_FILEPATH)
+    unique = np.append(0, agg.index)
+    size = np.append(agg.matrix.shape[1] - agg.sizes.sum(), agg.sizes)
 
-    nidx = 0
     tstep = []
+    source_ts = []
 
-    t1 = time.time()
-    print "Loading night files for {}_{}...".format(month, night)
-
-    # load raw images
-    for i in sorted(os.listdir(os.path.join(bb_settings.DATA_FILEPATH, month, night)))[file_start:file_stop:step]:
-        tstep.append(int(os.path.getmtime(os.path.join(bb_settings.DATA_FILEPATH, month, night, i))))
-
-
-        data = np.memmap(os.path.join(bb_settings.DATA_FILEPATH, month, night, i), dtype = np.uint8, mode = 'r')
-
-        img_cube[nidx, :, :] = data.reshape(bb_settings.IMG_SHAPE[0], bb_settings.IMG_SHAPE[1]).astype(np.float32)
-
-        nidx += 1
+    # integer (row, col) offset of the labels for each frame
+    nframes = len(range(file_start, file_stop, step))
+    if track_drift:
+        shifts = np.round(drift.night_drift(month, night)[file_start:file_stop:step, :2]).astype(int)
+    else:
+        shifts = np.zeros((nframes, 2), dtype=int)
 
-    unique, size = np.unique(bb_settings.LABELS_MASK, return_counts=True)
+    t1 = time.time()
+    print "Loading night files and creating time series array for {}_{}...".format(month, night)
 
-    t2 = time.time()
-    print "Time to load and reshape {}_{}: {}".format(month, night, t2 - t1)
-    print "Creating time series array for {}_{}...".format(month, night)
-    source_ts = []
+    # stream raw images and reduce each block straight into per-source means
+    # with one sparse product per block and shift (does not include '0' label)
+    for ts, block in read_frames(month, night, file_start, file_stop, step, chunk):
+        bshift = shifts[len(tstep):len(tstep) + len(ts)]
+        tstep.extend(ts)
 
+        src_mean = np.empty((len(ts), agg.index.size))
 
-    # does not include '0' label
-    for i in range(0, img_cube.shape[0]):
-        src_sum = mm.sum(img_cube[i, :, :].astype(
-            np.float32), bb_settings.LABELS_MASK, index=unique[1:])
-        source_ts.append(src_sum.astype(np.float32)/size[1:])
+        for sh in set(map(tuple, bshift)):
+            sel = (bshift == sh).all(1)
+            sagg = agg.shifted(*sh)
+            src_sum = sagg.sum(block if sel.all() else block[sel])
+            src_mean[sel] = src_sum.astype(np.float32)/sagg.sizes
 
+        source_ts.extend(src_mean)
 
     # stack sequence of time series into 2-d array time period x light source (index = unix timestamp of raw file)
     ts_array = np.stack(source_ts)
 
-    t3= time.time()
-    print "Time to create {}_{} time series array: {}".format(month, night, t3 - t2)
+    t3 = time.time()
+    print "Time to create {}_{} time series array: {}".format(month, night, t3 - t1)
+
+    if store is not None:
+        lcstore.LightcurveStore(store).append('{}_{}'.format(month, night), tstep, curves=ts_array)
 
     # broadcast timeseries of light sources into original image array
     if create_ts_cube:
         print "Broadcasting times series array to pixel image coordinates..."
 
-        ts_cube = np.zeros(img_cube.shape)
+        ts_cube = np.zeros((ts_array.shape[0], bb_settings.IMG_SHAPE[0], bb_settings.IMG_SHAPE[1]))
         for i in range(0, ts_cube.shape[1]):
             for j in range(0, ts_cube.shape[2]):
                 if LABELS[i, j] != 0:
@@ -145,7 +225,6 @@ def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, c
         class output():
 
             def __init__(self):
-                # self.cube = img_cube
                 self.unique = unique
                 self.size = size
                 self.curves = ts_array
@@ -157,29 +236,43 @@ def get_curves(month, night, output_dir, file_start=0, file_stop=2700, step=1, c
         return output()
 
 
-def multi_nights(output_dir, step=1, all_nights=False, nights=None):
+def curves_night(night, output_dir, step=1, store=None):
+    """
+    Run get_curves for a (month, night) tuple (worker for multi_nights).
+    """
 
-    start_all = time.time()
-    if all_nights:
-        for m in os.listdir(bb_settings.DATA_FILEPATH):
-            for n in os.listdir(os.path.join(bb_settings.DATA_FILEPATH, m)):
-                get_curves(month=m, night=n,
-                           output_dir=output_dir, step=step)
+    get_curves(month=night[0], night=night[1], output_dir=output_dir, step=step, store=store)
 
-    else:
-        if nights is None: # not include 7/24 and 7/31 due to camera data corruption
-            nights = [('06', '25'), ('06', '26'), ('06', '27'), ('06', '28'), 
-            ('06', '29'), ('06', '30'), ('07', '01'), ('07', '02'), ('07', '03'), 
-            ('07', '04'), ('07', '05'), ('07', '06'), ('07', '07'), ('07', '08'), 
-            ('07', '09'), ('07', '10'), ('07', '11'), ('07', '12'), ('07', '13'), ('07', '14'),
-            ('07','15'),('07','16'),('07','17'),('07','18'),('07','19'),('07','20'),('07','21'),
-            ('07','22'),('07','23'),('07','25'),('07','26'),('07','27'),('07','28'),
-            ('07','29'),('07','30'),('08','01'),('08','02'),('08','03'),('08','04'),
-            ('08','05'),('08','06'),('08','07'),('08','08'),('08','09'),('08','10'),('08','11'),
-            ('08','12'),('08','13'),('08','14'),('08','15'),('08','16'),('08','17'),('08','18'),('08','19')]
-
-        for n in nights:
-            get_curves(month=n[0], night=n[1],
-                       output_dir=output_dir, step=step)
-            
-    print "Total runtime for all nights: {}".format(time.time() - start_all)
+
+def multi_nights(output_dir, step=1, all_nights=False, nights=None, nproc=None,
+                 mem_budget=None, manifest=None, retries=1, store=None):
+    """
+    Extract lightcurves for many nights in parallel.
+
+    Nights are fanned out over a process pool whose size is capped by
+    mem_budget (bytes, each night is assumed to need NIGHT_MEMORY).  If
+    manifest is set, finished nights are recorded in that JSON file and
+    skipped on reruns; nights that still fail after retries are quarantined
+    there instead of aborting the batch.  The manifest must not live in
+    output_dir, which is expected to only hold lightcurve pickles.  If store
+    is set, each night is also appended to that lcstore.LightcurveStore.
+    """
+
+    if all_nights:
+        nights = [(m, n) for m in sorted(os.listdir(bb_settings.DATA_FILEPATH))
+                  for n in sorted(os.listdir(os.path.join(bb_settings.DATA_FILEPATH, m)))]
+
+    elif nights is None: # not include 7/24 and 7/31 due to camera data corruption
+        nights = [('06', '25'), ('06', '26'), ('06', '27'), ('06', '28'), 
+        ('06', '29'), ('06', '30'), ('07', '01'), ('07', '02'), ('07', '03'), 
+        ('07', '04'), ('07', '05'), ('07', '06'), ('07', '07'), ('07', '08'), 
+        ('07', '09'), ('07', '10'), ('07', '11'), ('07', '12'), ('07', '13'), ('07', '14'),
+        ('07','15'),('07','16'),('07','17'),('07','18'),('07','19'),('07','20'),('07','21'),
+        ('07','22'),('07','23'),('07','25'),('07','26'),('07','27'),('07','28'),
+        ('07','29'),('07','30'),('08','01'),('08','02'),('08','03'),('08','04'),
+        ('08','05'),('08','06'),('08','07'),('08','08'),('08','09'),('08','10'),('08','11'),
+        ('08','12'),('08','13'),('08','14'),('08','15'),('08','16'),('08','17'),('08','18'),('08','19')]
+
+    return scheduler.run_nights(curves_night, nights, manifest=manifest, nproc=nproc,
+                                mem_budget=mem_budget, mem_per_night=NIGHT_MEMORY,
+                                retries=retries, output_dir=output_dir, step=step, store=store)
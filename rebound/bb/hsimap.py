@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import bb_settings
+
+# -- default location of the persisted map
+MAP_FILEPATH = os.path.join(os.environ['REBOUND_WRITE'], 'final', 'bb_hsi_map.npz')
+
+
+class BBtoHSIMap(object):
+    """
+    Mapping between broadband (BB) and hyperspectral (HSI) pixel
+    coordinates: the inverse of the shift, rotation and scaling fitted to
+    matched sources (as in fit_sources), followed by a stretch of the HSI
+    columns by the HSI pixel aspect ratio.
+
+    Parameters
+    ----------
+    params : dict
+        Solution parameters: fac_hs (HSI aspect ratio), factor (mean BB/HSI
+        distance ratio), dr, dc, dtheta, scale (fitted shift, rotation in
+        degrees and residual scaling) and the BB and HSI offsets roff_bb,
+        coff_bb, roff_hsi, coff_hsi.
+    bb_shape, hsi_shape : tuple
+        (nrow, ncol) of the BB and HSI images.
+    bb_lut, hsi_lut : ndarray, optional
+        Lookup tables (see to_hsi_lut and to_bb_lut), built on first use
+        if None.
+
+    Attributes
+    ----------
+    matrix : ndarray
+        (2 x 3) affine matrix of the BB -> HSI mapping.
+    """
+
+    names = ('fac_hs', 'factor', 'dr', 'dc', 'dtheta', 'scale', 'roff_bb', 'coff_bb',
+             'roff_hsi', 'coff_hsi')
+
+    def __init__(self, params, bb_shape, hsi_shape, bb_lut=None, hsi_lut=None):
+
+        self.params    = dict((i, float(params[i])) for i in self.names)
+        self.bb_shape  = tuple(int(i) for i in bb_shape)
+        self.hsi_shape = tuple(int(i) for i in hsi_shape)
+        self._bb_lut   = bb_lut
+        self._hsi_lut  = hsi_lut
+
+        # -- affine matrix (from the images of the origin and unit vectors)
+        org = np.array(self.to_hsi(0., 0.))
+        self.matrix = np.array([np.array(self.to_hsi(1., 0.)) - org,
+                                np.array(self.to_hsi(0., 1.)) - org, org]).T
+
+    def to_hsi(self, rr, cc):
+        """
+        HSI (row, col) of BB (row, col) positions.
+        """
+
+        p  = self.params
+        th = -p['dtheta'] * np.pi / 180.
+
+        rrv = (np.asarray(rr, dtype=float) - p['roff_bb']) / p['factor'] - p['dr']
+        ccv = (np.asarray(cc, dtype=float) - p['coff_bb']) / p['factor'] - p['dc']
+
+        rt_hsi = (rrv * np.cos(th) - ccv * np.sin(th)) / p['scale'] + p['roff_hsi']
+        ct_hsi = ((rrv * np.sin(th) + ccv * np.cos(th)) / p['scale'] + p['coff_hsi']) \
+            * p['fac_hs']
+
+        return rt_hsi, ct_hsi
+
+    def to_bb(self, rr, cc):
+        """
+        BB (row, col) of HSI (row, col) positions (inverse of to_hsi).
+        """
+
+        inv = np.linalg.inv(self.matrix[:, :2])
+        rr  = np.asarray(rr, dtype=float) - self.matrix[0, 2]
+        cc  = np.asarray(cc, dtype=float) - self.matrix[1, 2]
+
+        return inv[0, 0] * rr + inv[0, 1] * cc, inv[1, 0] * rr + inv[1, 1] * cc
+
+    def _lut(self, func, src_shape, dst_shape, block):
+        """
+        Flat index of the nearest destination pixel of every source pixel
+        (-1 if outside of the destination), computed in blocks of rows.
+        """
+
+        dtype = np.int32 if dst_shape[0] * dst_shape[1] < 2**31 else np.int64
+        lut   = np.empty(src_shape, dtype=dtype)
+        cc    = np.arange(src_shape[1], dtype=float)
+
+        for r0 in range(0, src_shape[0], block):
+            rr     = np.arange(r0, min(r0 + block, src_shape[0]), dtype=float)[:, np.newaxis]
+            rt, ct = func(rr, cc)
+            rt, ct = rt.round(), ct.round()
+            good   = (rt >= 0) & (rt < dst_shape[0]) & (ct >= 0) & (ct < dst_shape[1])
+
+            lut[r0:r0 + rr.shape[0]] = np.where(good, rt * dst_shape[1] + ct, -1)
+
+        return lut
+
+    def to_hsi_lut(self, block=256):
+        """
+        Flat HSI index of each BB pixel, (nrow_bb x ncol_bb) int32.
+        """
+
+        if self._bb_lut is None:
+            self._bb_lut = self._lut(self.to_hsi, self.bb_shape, self.hsi_shape, block)
+
+        return self._bb_lut
+
+    def to_bb_lut(self, block=256):
+        """
+        Flat BB index of each HSI pixel, (nrow_hsi x ncol_hsi) int32.
+        """
+
+        if self._hsi_lut is None:
+            self._hsi_lut = self._lut(self.to_bb, self.hsi_shape, self.bb_shape, block)
+
+        return self._hsi_lut
+
+    def _pull(self, img, lut, fill):
+        """
+        Resample img at the pixels of a lookup table.
+        """
+
+        img  = np.asarray(img)
+        flat = img.reshape((-1,) + img.shape[2:])
+        good = lut >= 0
+        out  = np.full(lut.shape + img.shape[2:], fill, dtype=img.dtype)
+
+        out[good] = flat[lut[good]]
+
+        return out
+
+    def image_to_hsi(self, img, fill=0):
+        """
+        BB image (nrow_bb x ncol_bb [x nchan]) resampled on the HSI grid
+        (nearest BB pixel of each HSI pixel).
+        """
+
+        return self._pull(img, self.to_bb_lut(), fill)
+
+    def image_to_bb(self, img, fill=0):
+        """
+        HSI image (nrow_hsi x ncol_hsi [x nchan]) resampled on the BB grid
+        (nearest HSI pixel of each BB pixel).
+        """
+
+        return self._pull(img, self.to_hsi_lut(), fill)
+
+    def labels_to_hsi(self, labels, overwrite=True):
+        """
+        Transfer a BB label mask to the HSI grid by writing each BB pixel's
+        label at its HSI pixel, in raster order (as in fit_sources).
+
+        Parameters
+        ----------
+        labels : ndarray
+            BB label mask (nrow_bb x ncol_bb), 0 is background.
+        overwrite : bool, optional
+            If True, background pixels are written as well, so an HSI pixel
+            takes the label of the last BB pixel that maps onto it; if
+            False, only labelled BB pixels are written.
+
+        Returns
+        -------
+        ndarray
+            HSI label mask (nrow_hsi x ncol_hsi).
+        """
+
+        lut  = self.to_hsi_lut().ravel()
+        lab  = np.asarray(labels).ravel()
+        good = lut >= 0
+
+        if not overwrite:
+            good &= lab != 0
+
+        out = np.zeros(self.hsi_shape, dtype=lab.dtype)
+        out.flat[lut[good]] = lab[good]
+
+        return out
+
+    def labels_to_bb(self, labels):
+        """
+        Transfer an HSI label mask to the BB grid (label of the nearest HSI
+        pixel of each BB pixel).
+        """
+
+        return self._pull(labels, self.to_hsi_lut(), 0)
+
+    def save(self, fname=MAP_FILEPATH, luts=True):
+        """
+        Write the parameters (and lookup tables) to an .npz file.
+        """
+
+        arrs = dict(bb_shape=self.bb_shape, hsi_shape=self.hsi_shape, **self.params)
+
+        if luts:
+            arrs['bb_lut']  = self.to_hsi_lut()
+            arrs['hsi_lut'] = self.to_bb_lut()
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, **arrs)
+
+        os.rename(fname + '.tmp', fname)
+
+
+def solve(rr_hsi, cc_hsi, rr_bb, cc_bb, hsi_shape, bb_shape=bb_settings.IMG_SHAPE, asp=(0, 2)):
+    """
+    Fit the BB -> HSI solution to matched source positions.
+
+    Parameters
+    ----------
+    rr_hsi, cc_hsi : ndarray
+        HSI row/col positions of the sources.
+    rr_bb, cc_bb : ndarray
+        BB row/col positions of the same sources.
+    hsi_shape, bb_shape : tuple
+        (nrow, ncol) of the HSI and BB images.
+    asp : tuple, optional
+        Indices of the two sources used to measure the HSI aspect ratio.
+
+    Returns
+    -------
+    BBtoHSIMap
+        The mapping.
+    """
+
+    rrr0, ccc0 = np.array(rr_hsi, dtype=float), np.array(cc_hsi, dtype=float)
+    rrr1, ccc1 = np.array(rr_bb, dtype=float), np.array(cc_bb, dtype=float)
+
+    # -- correct for the aspect ratio of the HSI pixels
+    asp0, asp1 = asp
+    rat_bb = (rrr1[asp0] - rrr1[asp1]) / (ccc1[asp1] - ccc1[asp0])
+    rat_hs = (rrr0[asp1] - rrr0[asp0]) / (ccc0[asp0] - ccc0[asp1])
+    fac_hs = rat_bb / rat_hs
+
+    ccc0 /= fac_hs
+
+    # -- get the mean scaling factor between distances
+    dist_hs = np.sqrt((rrr0[:, np.newaxis] - rrr0)**2 +
+                      (ccc0[:, np.newaxis] - ccc0)**2)
+    dist_bb = np.sqrt((rrr1[:, np.newaxis] - rrr1)**2 +
+                      (ccc1[:, np.newaxis] - ccc1)**2)
+    factor  = (dist_bb[dist_bb > 0]/dist_hs[dist_bb>0]).mean()
+
+    # -- center the positions
+    roff_hsi = hsi_shape[0] // 2
+    coff_hsi = hsi_shape[1] // 2 / fac_hs
+    roff_bb  = bb_shape[0] // 2
+    coff_bb  = bb_shape[1] // 2
+
+    rrr0 -= roff_hsi
+    ccc0 -= coff_hsi
+    rrr1  = (rrr1 - roff_bb) / factor
+    ccc1  = (ccc1 - coff_bb) / factor
+
+    # -- least-squares rotation and shift
+    pm         = np.zeros([rrr0.size * 2, 4])
+    pm[::2,0]  = rrr0
+    pm[1::2,0] = ccc0
+    pm[::2,1]  = -ccc0
+    pm[1::2,1] = rrr0
+    pm[::2,2]  = 1.0
+    pm[1::2,3] = 1.0
+
+    bv         = np.zeros([rrr0.size * 2])
+    bv[::2]    = rrr1
+    bv[1::2]   = ccc1
+
+    pmTpm = np.dot(pm.T, pm)
+    av    = np.dot(np.linalg.inv(pmTpm), np.dot(pm.T, bv))
+
+    params = dict(fac_hs=fac_hs, factor=factor, dr=av[2], dc=av[3],
+                  dtheta=np.arctan2(av[1], av[0]) * 180. / np.pi, scale=np.hypot(av[0], av[1]),
+                  roff_bb=roff_bb, coff_bb=coff_bb, roff_hsi=roff_hsi, coff_hsi=coff_hsi)
+
+    return BBtoHSIMap(params, bb_shape, hsi_shape)
+
+
+def fit(hsi_shape, sources=None, bb_shape=bb_settings.IMG_SHAPE, asp=(0, 2)):
+    """
+    Fit the BB -> HSI solution to the matched sources of a sources.csv
+    file (columns hs_r, hs_c, bb_r, bb_c; default
+    $REBOUND_WRITE/sources.csv).
+    """
+
+    import pandas as pd
+
+    sources = os.path.join(os.environ['REBOUND_WRITE'], 'sources.csv') if sources is None \
+        else sources
+    srcs    = pd.read_csv(sources)
+
+    return solve(srcs.hs_r.values, srcs.hs_c.values, srcs.bb_r.values, srcs.bb_c.values,
+                 hsi_shape, bb_shape, asp)
+
+
+def load(fname=MAP_FILEPATH):
+    """
+    Read a BBtoHSIMap written by BBtoHSIMap.save.
+    """
+
+    npz = np.load(fname)
+
+    return BBtoHSIMap(dict((i, npz[i]) for i in BBtoHSIMap.names), npz['bb_shape'],
+                      npz['hsi_shape'], npz['bb_lut'] if 'bb_lut' in npz.files else None,
+                      npz['hsi_lut'] if 'hsi_lut' in npz.files else None)
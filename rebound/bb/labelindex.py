@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+
+# -- indices built from label files, keyed on (path, mtime)
+_CACHE = {}
+
+
+class LabelIndex(object):
+    """
+    Index of the pixels of each source in a label mask, stored CSR-style
+    (the flat pixel indices of all sources concatenated in label order),
+    so that the pixels, size, bounding box or centroid of a source are
+    found in O(source size) rather than by scanning the whole mask.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the label mask (nrows x ncols).
+    labels : ndarray
+        Sorted, unique, nonzero labels.
+    indptr : ndarray
+        Pixels of labels[i] are pixels[indptr[i]:indptr[i + 1]].
+    pixels : ndarray
+        Flat pixel indices, sorted within each label.
+
+    Attributes
+    ----------
+    sizes : ndarray
+        Number of pixels of each label.
+    bboxes : ndarray
+        Row min, row max, column min, column max (inclusive) of each label
+        (nlabels x 4).
+    centroids : ndarray
+        Mean row and column of each label (nlabels x 2).
+    """
+
+    def __init__(self, shape, labels, indptr, pixels):
+
+        self.shape  = tuple(int(i) for i in shape)
+        self.labels = np.asarray(labels)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.pixels = np.asarray(pixels)
+
+        self.sizes = np.diff(self.indptr)
+
+        rr, cc = self.pixels // self.shape[1], self.pixels % self.shape[1]
+
+        if self.labels.size:
+            starts = self.indptr[:-1]
+            self.bboxes = np.array([np.minimum.reduceat(rr, starts), np.maximum.reduceat(rr, starts),
+                                    np.minimum.reduceat(cc, starts), np.maximum.reduceat(cc, starts)]).T
+            self.centroids = np.array([np.add.reduceat(rr, starts, dtype=np.float64),
+                                       np.add.reduceat(cc, starts, dtype=np.float64)]).T \
+                / self.sizes[:, np.newaxis]
+        else:
+            self.bboxes    = np.zeros((0, 4), dtype=np.int64)
+            self.centroids = np.zeros((0, 2))
+
+    def __len__(self):
+        return self.labels.size
+
+    def position(self, labels):
+        """
+        Position of labels in the index (-1 if not in the index).
+        """
+
+        labels = np.asarray(labels)
+        pos    = np.searchsorted(self.labels, labels).clip(0, max(self.labels.size - 1, 0))
+        hit    = self.labels[pos] == labels if self.labels.size else np.zeros(labels.shape, bool)
+
+        return np.where(hit, pos, -1)
+
+    def pixels_of(self, label):
+        """
+        Flat pixel indices of a label.
+        """
+
+        pos = int(self.position(label))
+
+        if pos < 0:
+            return self.pixels[:0]
+
+        return self.pixels[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def coords_of(self, label):
+        """
+        (rows, cols) of the pixels of a label.
+        """
+
+        pix = self.pixels_of(label)
+
+        return pix // self.shape[1], pix % self.shape[1]
+
+    def size_of(self, labels):
+        """
+        Number of pixels of labels (0 if not in the index).
+        """
+
+        return np.append(self.sizes, 0)[self.position(labels)]
+
+    def pixel_labels(self):
+        """
+        Label of each entry of pixels.
+        """
+
+        return np.repeat(self.labels, self.sizes)
+
+    def unique(self):
+        """
+        Labels and sizes including the background (0), as
+        np.unique(mask, return_counts=True).
+        """
+
+        nback = self.shape[0] * self.shape[1] - self.pixels.size
+
+        if nback == 0:
+            return self.labels, self.sizes
+
+        return np.append(0, self.labels), np.append(nback, self.sizes)
+
+    def _take(self, keep):
+        """
+        Index of the labels selected by a boolean array.
+        """
+
+        starts  = self.indptr[:-1][keep]
+        sizes   = self.sizes[keep]
+        indptr  = np.append(0, np.cumsum(sizes))
+        offsets = np.repeat(starts - indptr[:-1], sizes)
+
+        return LabelIndex(self.shape, self.labels[keep], indptr,
+                          self.pixels[np.arange(indptr[-1]) + offsets])
+
+    def filter(self, min_size=None, max_size=None):
+        """
+        Index of the labels with min_size <= size <= max_size.
+        """
+
+        keep = np.ones(self.labels.size, dtype=bool)
+
+        if min_size is not None:
+            keep &= self.sizes >= min_size
+        if max_size is not None:
+            keep &= self.sizes <= max_size
+
+        return self._take(keep)
+
+    def subset(self, labels):
+        """
+        Index of the labels that are in labels.
+        """
+
+        keep = np.zeros(self.labels.size, dtype=bool)
+        pos  = self.position(np.asarray(labels).ravel())
+        keep[pos[pos >= 0]] = True
+
+        return self._take(keep)
+
+    def relabel(self, new):
+        """
+        Index with labels[i] renamed to new[i] (labels mapped to the same
+        new label are merged, and new labels of 0 are dropped).
+        """
+
+        new = np.asarray(new)
+
+        # -- sorted, unique new labels only need renaming
+        if new.size == 0 or (new[0] > 0 and (np.diff(new) > 0).all()):
+            return LabelIndex(self.shape, new, self.indptr, self.pixels)
+
+        lab   = np.repeat(new, self.sizes)
+        order = np.lexsort((self.pixels, lab))
+        lab, pixels = lab[order], self.pixels[order]
+        keep  = lab != 0
+        lab, pixels = lab[keep], pixels[keep]
+
+        uniq, starts = np.unique(lab, return_index=True)
+
+        return LabelIndex(self.shape, uniq, np.append(starts, lab.size), pixels)
+
+    def crop(self, rows, cols):
+        """
+        Index of a sub-region of the mask, rows and cols given as (start,
+        stop) (e.g. Gowanus).
+        """
+
+        rr, cc = self.pixels // self.shape[1], self.pixels % self.shape[1]
+        keep   = (rr >= rows[0]) & (rr < rows[1]) & (cc >= cols[0]) & (cc < cols[1])
+        ncol   = cols[1] - cols[0]
+        lab    = self.pixel_labels()[keep]
+        pixels = (rr[keep] - rows[0]) * ncol + cc[keep] - cols[0]
+
+        uniq, starts = np.unique(lab, return_index=True)
+
+        return LabelIndex((rows[1] - rows[0], ncol), uniq, np.append(starts, lab.size), pixels)
+
+    def mask(self, dtype=None):
+        """
+        Dense label mask (nrows x ncols).
+        """
+
+        out = np.zeros(self.shape, dtype=self.labels.dtype if dtype is None else dtype)
+        out.flat[self.pixels] = self.pixel_labels()
+
+        return out
+
+    def mean(self, img, labels=None):
+        """
+        Mean of an image (nrows x ncols) over the pixels of each label (or
+        of labels, nan for labels not in the index).
+        """
+
+        vals  = np.asarray(img).ravel()[self.pixels]
+        means = np.add.reduceat(vals, self.indptr[:-1], dtype=np.float64) / self.sizes \
+            if self.labels.size else np.zeros(0)
+
+        if labels is None:
+            return means
+
+        return np.append(means, np.nan)[self.position(labels)]
+
+    def save(self, fname, **kwargs):
+        """
+        Write the index (and any extra keys) to an .npz file.
+        """
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, shape=self.shape, labels=self.labels, indptr=self.indptr,
+                     pixels=self.pixels, **kwargs)
+
+        os.rename(fname + '.tmp', fname)
+
+
+def from_mask(labels):
+    """
+    Build the LabelIndex of a label mask (0 is background).
+    """
+
+    labels = np.asarray(labels)
+    flat   = labels.ravel()
+    pix    = np.flatnonzero(flat)
+    lab    = flat[pix]
+
+    # -- stable sort keeps the pixels of each label in order
+    order  = np.argsort(lab, kind='mergesort')
+    pixels = pix[order].astype(np.int32 if flat.size < 2**31 else np.int64)
+    lab    = lab[order]
+
+    uniq, starts = np.unique(lab, return_index=True)
+
+    return LabelIndex(labels.shape, uniq, np.append(starts, lab.size), pixels)
+
+
+def load(fname):
+    """
+    Read a LabelIndex written by LabelIndex.save.
+    """
+
+    npz = np.load(fname)
+
+    return LabelIndex(npz['shape'], npz['labels'], npz['indptr'], npz['pixels'])
+
+
+def from_file(fname):
+    """
+    Return the (cached) LabelIndex of a saved label mask (.npy).
+
+    The index is persisted next to the mask (NAME_index.npz) and is valid
+    while the mask's size and mtime are unchanged.
+    """
+
+    st  = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_mtime)
+
+    if key in _CACHE:
+        return _CACHE[key]
+
+    cfile = os.path.splitext(fname)[0] + '_index.npz'
+
+    if os.path.isfile(cfile):
+        npz = np.load(cfile)
+
+        if int(npz['size']) == st.st_size and float(npz['mtime']) == st.st_mtime:
+            _CACHE[key] = LabelIndex(npz['shape'], npz['labels'], npz['indptr'], npz['pixels'])
+
+            return _CACHE[key]
+
+    index = from_mask(np.load(fname, mmap_mode='r'))
+
+    try:
+        index.save(cfile, size=st.st_size, mtime=st.st_mtime)
+    except (IOError, OSError):
+        pass
+
+    _CACHE[key] = index
+
+    return index
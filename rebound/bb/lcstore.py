@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import events
+import cPickle as pickle
+
+
+class LightcurveStore(object):
+    """
+    Consolidated, appendable on-disk store of per-night lightcurve arrays.
+
+    Each night's (nobs x nsources) arrays are written source-major as .npy
+    files (name_MM_DD.npy of shape nsources x nobs).  The night's timestamps
+    (tstamps_MM_DD.npy) are written last and act as the index, so nights can
+    be appended by independent processes.  Nights that are still being
+    recorded can be appended one observation at a time (append_frame) and
+    converted once complete (finalize).  Arrays are opened lazily as
+    memmaps, so reading a subset of sources only touches those sources' rows
+    on disk.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store (created if it does not exist).
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def nights(self):
+        return sorted(i[len('tstamps_'):-len('.npy')] for i in os.listdir(self.path)
+                      if i.startswith('tstamps_'))
+
+    def _fname(self, name, night):
+        return os.path.join(self.path, '{}_{}.npy'.format(name, night))
+
+    def has(self, name, night):
+        return os.path.isfile(self._fname(name, night))
+
+    def append(self, night, tstamps, **arrays):
+        """
+        Add (or replace) a night.
+
+        Parameters
+        ----------
+        night : str
+            Night key, formatted as "MM_DD".
+        tstamps : ndarray
+            Timestamps of the night (nobs).
+        arrays : ndarray
+            Named (nobs x nsources) arrays, e.g. curves=lcs, ons=ons.
+        """
+
+        for name, arr in arrays.items():
+            np.save(self._fname(name, night), np.ascontiguousarray(np.asarray(arr).T))
+
+        # -- timestamps last: a night is listed once all its arrays exist
+        np.save(self._fname('tstamps', night), np.asarray(tstamps))
+
+    def open(self, name, night):
+        """
+        Lazily open a night's array as a (nsources x nobs) memmap.
+        """
+
+        return np.load(self._fname(name, night), mmap_mode='r')
+
+    def _live_fname(self, name, night):
+        return os.path.join(self.path, 'live_{}_{}.bin'.format(name, night))
+
+    def append_frame(self, night, tstamp, **rows):
+        """
+        Append one observation of a night that is still being recorded.
+
+        Rows are appended frame-major to raw live_name_MM_DD.bin files
+        (float32 values, int64 timestamps), so appending costs the same at
+        any point of the night; the night is only listed once finalized.
+
+        Parameters
+        ----------
+        night : str
+            Night key, formatted as "MM_DD".
+        tstamp : int
+            Timestamp of the observation.
+        rows : ndarray
+            Named (nsources) rows, e.g. curves=values.
+        """
+
+        for name, row in rows.items():
+            with open(self._live_fname(name, night), 'ab') as f:
+                np.asarray(row, dtype=np.float32).tofile(f)
+
+        with open(self._live_fname('tstamps', night), 'ab') as f:
+            np.array([tstamp], dtype=np.int64).tofile(f)
+
+    def live_tstamps(self, night):
+        """
+        Timestamps of the observations appended so far to a live night.
+        """
+
+        return np.fromfile(self._live_fname('tstamps', night), dtype=np.int64)
+
+    def resume_live(self, night, nsrc):
+        """
+        Number of observations already appended to a live night (0 if
+        none), truncating any row written after the last timestamp (an
+        interrupted append) so that appending can resume.
+        """
+
+        if not os.path.isfile(self._live_fname('tstamps', night)):
+            return 0
+
+        nobs = self.live_tstamps(night).size
+
+        for i in os.listdir(self.path):
+            if i.startswith('live_') and i.endswith('_{}.bin'.format(night)) \
+                    and i != os.path.basename(self._live_fname('tstamps', night)):
+                with open(os.path.join(self.path, i), 'r+b') as f:
+                    f.truncate(nobs * nsrc * 4)
+
+        return nobs
+
+    def open_live(self, name, night, nsrc):
+        """
+        Open the observations appended so far to a live night as a
+        (nobs x nsources) memmap.
+        """
+
+        nobs = self.live_tstamps(night).size
+
+        return np.memmap(self._live_fname(name, night), dtype=np.float32, mode='r',
+                         shape=(nobs, nsrc))
+
+    def finalize(self, night, nsrc):
+        """
+        Convert a live night to the regular (source-major) layout.
+
+        Parameters
+        ----------
+        night : str
+            Night key, formatted as "MM_DD".
+        nsrc : int
+            Number of sources per row.
+        """
+
+        names = [i[len('live_'):-len('_{}.bin'.format(night))] for i in os.listdir(self.path)
+                 if i.startswith('live_') and i.endswith('_{}.bin'.format(night))]
+        names.remove('tstamps')
+
+        tstamps = self.live_tstamps(night)
+        arrays  = dict((name, np.array(self.open_live(name, night, nsrc))) for name in names)
+
+        self.append(night, tstamps, **arrays)
+
+        for name in names + ['tstamps']:
+            os.remove(self._live_fname(name, night))
+
+    def tstamps(self, nights=None, cube=True):
+        """
+        Timestamps of the selected nights, (nnights x nobs) if cube,
+        concatenated otherwise.
+        """
+
+        nights = self.nights if nights is None else nights
+        ts     = [np.load(self._fname('tstamps', n)) for n in nights]
+
+        return np.stack(ts) if cube else np.concatenate(ts)
+
+    def read(self, name='curves', sources=None, nights=None, cube=True):
+        """
+        Read an array for a subset of sources and nights.
+
+        Parameters
+        ----------
+        name : str
+            Name of the array (e.g. 'curves', 'ons', 'offs').
+        sources : array-like, optional
+            Source (column) indices to read; all if None.
+        nights : list, optional
+            Night keys to read; all if None.
+        cube : bool
+            If True, return (nnights x nobs x nsources), otherwise
+            (total nobs x nsources).
+
+        Returns
+        -------
+        ndarray
+            The requested data.
+        """
+
+        nights = self.nights if nights is None else nights
+
+        # -- read rows in on-disk order, then restore the requested order
+        if sources is not None:
+            uind, inv = np.unique(sources, return_inverse=True)
+
+        out = []
+
+        for night in nights:
+            arr = self.open(name, night)
+
+            if sources is not None:
+                arr = arr[uind][inv]
+
+            out.append(np.asarray(arr).T)
+
+        return np.stack(out) if cube else np.concatenate(out, axis=0)
+
+
+def import_pickles(store_path, curves_dir=None, edges_dir=None):
+    """
+    Consolidate existing per-night lightcurve and edge pickles into a
+    LightcurveStore.
+
+    Parameters
+    ----------
+    store_path : str
+        Directory of the store.
+    curves_dir : str, optional
+        Directory of lightcurves_and_tstamps_tuple_MM_DD.pkl files.
+    edges_dir : str, optional
+        Directory of edge_events_MM_DD.npz (or legacy edge_obj_MM_DD.pkl)
+        files (adds 'gd', 'ons', 'offs').
+
+    Returns
+    -------
+    LightcurveStore
+        The populated store.
+    """
+
+    store = LightcurveStore(store_path)
+
+    if curves_dir is not None:
+        for i in sorted(os.listdir(curves_dir)):
+            night = '_'.join(i.split('.')[0].split('_')[-2:])
+
+            with open(os.path.join(curves_dir, i), 'rb') as file:
+                lc, ts = pickle.load(file)
+
+            store.append(night, ts, curves=lc)
+            print("added curves for {}".format(night))
+
+    if edges_dir is not None:
+        for i in sorted(os.listdir(edges_dir)):
+            night = '_'.join(i.split('.')[0].split('_')[-2:])
+
+            lc, lcgd, on, off, ts = events.load_edges(os.path.join(edges_dir, i))
+
+            arrays = dict(gd=np.ma.getdata(lcgd), ons=on, offs=off)
+
+            # -- lightcurves are only kept once
+            if not store.has('curves', night):
+                arrays['curves'] = lc
+
+            store.append(night, ts, **arrays)
+            print("added edges for {}".format(night))
+
+    return store
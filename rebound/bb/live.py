@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import numpy as np
+import bb_settings
+import aggregate
+import lcstore
+import manifest
+import events
+
+# -- record of an event in a night's live event log
+EVENT_DTYPE = np.dtype([('src', np.int32), ('idx', np.int32), ('tstamp', np.int64),
+                        ('kind', np.int8), ('strength', np.float32)])
+
+
+class OnlineEdgeDetector(object):
+    """
+    Causal, bounded-lag version of the detect_onoff.edge on/off detector
+    that is fed one observation (row of source values) at a time.
+
+    The Gaussian smoothing kernel (sigma=width) is truncated at lag
+    observations into the future, so the Gaussian difference of
+    observation i is known once observation i + lag + delta is pushed and
+    its extrema one observation later (observations within this latency
+    of the end of the night are never tested).  Means and standard
+    deviations of the Gaussian difference are running sigma-clipped
+    estimates (rather than whole-night ones) and the right window of the
+    cross check is limited to the observations already received.  All
+    state is held in fixed-size ring buffers, so the cost per observation
+    and the memory do not grow over the night.
+
+    Parameters
+    ----------
+    nsrc : int
+        Number of sources.
+    width : int, optional
+        Width of the Gaussian filter and cross check windows.
+    delta : int, optional
+        Offset of the Gaussian difference.
+    lag : int, optional
+        Number of future observations used in the smoothing.
+    s_peaks, s_clip_amp, s_xcheck : float, optional
+        Thresholds as in detect_onoff.edge.
+    warmup : int, optional
+        Number of Gaussian difference samples per source accumulated before
+        clipping is applied to the running statistics.
+    truncate : float, optional
+        Past extent of the smoothing kernel in units of width.
+    """
+
+    def __init__(self, nsrc, width=30, delta=2, lag=10, s_peaks=0.0, s_clip_amp=2.0,
+                 s_xcheck=2.0, warmup=60, truncate=4.0):
+
+        self.nsrc       = nsrc
+        self.width      = width
+        self.delta      = delta
+        self.lag        = lag
+        self.sig_peaks  = s_peaks
+        self.sig_clip   = s_clip_amp
+        self.sig_xcheck = s_xcheck
+        self.warmup     = warmup
+
+        # -- smoothing kernel over offsets -radius..lag
+        radius      = int(truncate * width + 0.5)
+        self.offs   = np.arange(-radius, lag + 1)
+        self.kernel = np.exp(-0.5 * (self.offs / float(width))**2)
+
+        # -- ring buffers: raw values, smoothed values, gaussian difference
+        self.nraw  = max(radius + lag + 1, 2 * width + lag + delta + 2)
+        self.raw   = np.zeros((self.nraw, nsrc))
+        self.valid = np.zeros((self.nraw, nsrc), dtype=bool)
+        self.ts    = np.zeros(self.nraw, dtype=np.int64)
+        self.sm    = np.zeros((delta + 1, nsrc))
+        self.smok  = np.zeros((delta + 1, nsrc), dtype=bool)
+        self.gd    = np.zeros((3, nsrc))
+        self.gdok  = np.zeros((3, nsrc), dtype=bool)
+
+        # -- running (clipped) statistics of the gaussian difference
+        self.cnt = np.zeros(nsrc)
+        self.avg = np.zeros(nsrc)
+        self.m2  = np.zeros(nsrc)
+
+        self.nobs = 0
+
+    @property
+    def latency(self):
+        """
+        Number of observations between an observation and its events.
+        """
+
+        return self.lag + self.delta - self.delta // 2 + 1
+
+    def _window(self, start, stop):
+        """
+        Ring buffer rows of observations [start, stop), clipped to those
+        received.
+        """
+
+        return np.arange(max(start, 0, self.nobs - self.nraw), min(stop, self.nobs)) % self.nraw
+
+    def _smooth(self, s):
+        """
+        Gaussian smoothing of observation s from the observations received,
+        weighting out missing (-99999) values.
+        """
+
+        lo   = max(s + self.offs[0], 0)
+        rows = self._window(lo, s + self.offs[-1] + 1)
+        kern = self.kernel[lo - s - self.offs[0]:][:rows.size, np.newaxis]
+        wgt  = kern * self.valid[rows]
+        norm = wgt.sum(0)
+
+        sm = (wgt * self.raw[rows]).sum(0) / (norm + (norm == 0))
+        ok = norm > 0.9999 * kern.sum()
+
+        return sm, ok
+
+    def _update_stats(self, gd, ok):
+        """
+        Add the unmasked, unclipped samples of a gaussian difference row to
+        the running mean and variance (Welford).
+        """
+
+        sig  = np.sqrt(self.m2 / np.maximum(self.cnt, 1))
+        keep = ok & ((self.cnt < self.warmup) | (np.abs(gd - self.avg) <= self.sig_clip * sig))
+
+        self.cnt += keep
+        dd        = np.where(keep, gd - self.avg, 0)
+        self.avg += dd / np.maximum(self.cnt, 1)
+        self.m2  += dd * np.where(keep, gd - self.avg, 0)
+
+    def _xcheck(self, i, src):
+        """
+        Left/right window cross check of observation i for a set of sources.
+        """
+
+        left  = self._window(i - self.width, i)
+        right = self._window(i, i + self.width)
+
+        if left.size == 0 or right.size == 0:
+            return np.zeros(src.size, dtype=bool)
+
+        vl, vr = self.raw[left][:, src], self.raw[right][:, src]
+        md     = np.abs(vr.mean(0) - vl.mean(0))
+        std    = np.sqrt(np.maximum((vl**2).mean(0) - vl.mean(0)**2,
+                                    (vr**2).mean(0) - vr.mean(0)**2))
+
+        return md > self.sig_xcheck * std
+
+    def push(self, values, tstamp):
+        """
+        Add an observation and return the events it completes.
+
+        Parameters
+        ----------
+        values : ndarray
+            Source values of the observation (nsources).
+        tstamp : int
+            Timestamp of the observation.
+
+        Returns
+        -------
+        ndarray
+            Events (EVENT_DTYPE records) of the observation latency
+            observations before this one.
+        """
+
+        n = self.nobs
+        self.raw[n % self.nraw]   = values
+        self.valid[n % self.nraw] = values > -9999
+        self.ts[n % self.nraw]    = tstamp
+        self.nobs += 1
+
+        # -- smoothed value of observation s
+        s = n - self.lag
+        if s < 0:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+
+        self.sm[s % (self.delta + 1)], self.smok[s % (self.delta + 1)] = self._smooth(s)
+
+        # -- gaussian difference of observation j
+        j = s - (self.delta - self.delta // 2)
+        if j - self.delta // 2 < 0:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+
+        hi, lo = s % (self.delta + 1), (s - self.delta) % (self.delta + 1)
+        self.gd[j % 3]   = self.sm[hi] - self.sm[lo]
+        self.gdok[j % 3] = self.smok[hi] & self.smok[lo]
+        self._update_stats(self.gd[j % 3], self.gdok[j % 3])
+
+        # -- extrema of observation i
+        i = j - 1
+        if i < 1:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+
+        prv, cur, nxt = self.gd[(i - 1) % 3], self.gd[i % 3], self.gd[(i + 1) % 3]
+        thr  = self.sig_peaks * np.sqrt(self.m2 / np.maximum(self.cnt, 1))
+        ok   = self.gdok[i % 3]
+        ons  = (cur - self.avg > thr) & (cur > nxt) & (cur > prv) & ok
+        offs = (cur - self.avg < -thr) & (cur < nxt) & (cur < prv) & ok
+
+        src = np.flatnonzero(ons | offs)
+        src = src[self._xcheck(i, src)]
+
+        evts = np.zeros(src.size, dtype=EVENT_DTYPE)
+        evts['src']      = src
+        evts['idx']      = i
+        evts['tstamp']   = self.ts[i % self.nraw]
+        evts['kind']     = np.where(ons[src], events.ON, events.OFF)
+        evts['strength'] = cur[src]
+
+        return evts
+
+
+def _frame_ready(fname, nbytes):
+    """
+    True once a raw file has been completely written.
+    """
+
+    return os.path.getsize(fname) >= nbytes
+
+
+def tail_night(month, night, store=None, output_dir=None, poll=1.0, timeout=600.,
+               lag=10, **kwargs):
+    """
+    Follow a night's raw directory while it is being recorded, appending
+    each new frame's source means to the lightcurve store and detecting
+    on/off transitions with a bounded lag.  A restarted tail resumes after
+    the frames already in the store.
+
+    Parameters
+    ----------
+    month, night : str
+        Month and night directories of the raw images.
+    store : str, optional
+        Path of the lcstore.LightcurveStore (default bb_settings.STORE_PATH).
+    output_dir : str, optional
+        Directory of the night's final event table; default
+        bb_settings.EDGE_PATH (the live event log is kept in the store).
+    poll : float, optional
+        Seconds between directory polls.
+    timeout : float, optional
+        The night is considered complete after this many seconds without
+        a new frame.
+    lag : int, optional
+        Number of future observations used by the detector.
+    kwargs : optional
+        Other parameters of OnlineEdgeDetector.
+
+    Returns
+    -------
+    EdgeEvents
+        The night's events (also written to edge_events_MM_DD.npz in
+        output_dir once the night is complete, referencing the store's
+        curves_MM_DD.npy); empty, and nothing is written, if no frame
+        arrived.
+    """
+
+    store      = lcstore.LightcurveStore(bb_settings.STORE_PATH if store is None else store)
+    output_dir = bb_settings.EDGE_PATH if output_dir is None else output_dir
+    data_dir   = os.path.join(bb_settings.DATA_FILEPATH, month, night)
+    key        = '{}_{}'.format(month, night)
+    nbytes     = bb_settings.IMG_SHAPE[0] * bb_settings.IMG_SHAPE[1]
+    # -- the live event log is kept with the store's live files, so that only
+    #    the final event table is written to output_dir
+    log        = os.path.join(store.path, 'events_{}.log'.format(key))
+
+    agg = aggregate.from_file(bb_settings.LABELS_FILEPATH)
+    det = OnlineEdgeDetector(agg.index.size, lag=lag, **kwargs)
+
+    # -- a restarted tail resumes after the frames already stored, replaying
+    #    them through the detector and rewriting the event log to match
+    nseen = store.resume_live(key, agg.index.size)
+
+    with open(log, 'wb') as f:
+        if nseen:
+            curves = store.open_live('curves', key, agg.index.size)
+            for values, tstamp in zip(curves, store.live_tstamps(key)):
+                det.push(np.array(values), tstamp).tofile(f)
+
+    tlast = time.time()
+
+    while time.time() - tlast < timeout:
+        nprev = nseen
+
+        # -- the directory is only relisted once it has changed
+        for path in manifest.scan(data_dir).paths(nseen):
+            # -- wait for a partially written frame
+            if not _frame_ready(path, nbytes):
+                break
+
+            t0     = time.time()
+            img    = np.fromfile(path, dtype=np.uint8).reshape(bb_settings.IMG_SHAPE)
+            tstamp = int(os.path.getmtime(path))
+            values = (agg.sum(img) / agg.sizes).astype(np.float32)
+
+            store.append_frame(key, tstamp, curves=values)
+
+            # -- events are logged as they are found, not held in memory
+            evts = det.push(values, tstamp)
+            with open(log, 'ab') as f:
+                evts.tofile(f)
+
+            nseen += 1
+            tlast  = time.time()
+
+            print("frame {}: {} events in {:.2f}s".format(nseen, evts.size, tlast - t0))
+
+        if nseen == nprev:
+            time.sleep(poll)
+
+    print("no new frames for {}s, finalizing {}...".format(timeout, key))
+
+    # -- nothing to finalize if no frame arrived
+    if nseen == 0:
+        os.remove(log)
+
+        return events.EdgeEvents(np.zeros(0, np.int32), np.zeros(0, np.int32),
+                                 np.zeros(0, np.int64), np.zeros(0, np.int8),
+                                 np.zeros(0, np.float32), np.zeros(0, np.int64),
+                                 agg.index.size, None, det.width, det.delta)
+
+    # -- convert the live night and its event log to the batch formats
+    tstamps = store.live_tstamps(key)
+    store.finalize(key, agg.index.size)
+
+    log_evts = np.fromfile(log, dtype=EVENT_DTYPE) if os.path.isfile(log) \
+        else np.zeros(0, dtype=EVENT_DTYPE)
+    evts = events.EdgeEvents(log_evts['src'], log_evts['idx'], log_evts['tstamp'],
+                             log_evts['kind'], log_evts['strength'], tstamps,
+                             agg.index.size, store._fname('curves', key), det.width, det.delta)
+    evts.save(os.path.join(output_dir, 'edge_events_{}.npz'.format(key)))
+
+    if os.path.isfile(log):
+        os.remove(log)
+
+    return evts
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import numpy as np
+
+
+# -- manifests already read in this process, keyed on night directory
+_CACHE = {}
+
+
+class NightManifest(object):
+    """
+    Sorted list of the raw files of a night with their sizes and mtimes.
+
+    Attributes
+    ----------
+    data_dir : str
+        Directory of the night's raw files.
+    dir_mtime : float
+        Modification time of data_dir when it was scanned.
+    fnames : ndarray
+        Sorted file names; the position in this array is the frame index.
+    sizes : ndarray
+        File sizes in bytes.
+    mtimes : ndarray
+        File modification times (float Unix timestamps).
+    """
+
+    def __init__(self, data_dir, dir_mtime, fnames, sizes, mtimes):
+
+        self.data_dir  = data_dir
+        self.dir_mtime = dir_mtime
+        self.fnames    = fnames
+        self.sizes     = sizes
+        self.mtimes    = mtimes
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def paths(self, start=None, stop=None, step=None):
+        """
+        Full paths of a slice of the night's files.
+        """
+
+        return [os.path.join(self.data_dir, i) for i in self.fnames[start:stop:step]]
+
+    def tstamps(self, start=None, stop=None, step=None):
+        """
+        Integer (naive Unix) timestamps of a slice of the night's files.
+        """
+
+        return self.mtimes[start:stop:step].astype(np.int64)
+
+
+def cache_file(data_dir, prefix='manifest', cache_dir=None):
+    """
+    Path of a per-night cache file (e.g. the manifest itself or products
+    derived from it), keyed on the night directory.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ['REBOUND_WRITE'], 'manifests')
+
+    key = hashlib.md5(os.path.abspath(data_dir)).hexdigest()
+
+    return os.path.join(cache_dir, '{}_{}.npz'.format(prefix, key))
+
+
+def scan(data_dir, cache_dir=None, refresh=False):
+    """
+    Return the manifest of a night directory, listing and stat-ing the raw
+    files only if the directory changed since the manifest was persisted.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory of the night's raw files.
+    cache_dir : str, optional
+        Directory for persisted manifests (default $REBOUND_WRITE/manifests).
+    refresh : bool, optional
+        Force a rescan.
+
+    Returns
+    -------
+    NightManifest
+        The night's manifest.
+    """
+
+    dir_mtime = os.path.getmtime(data_dir)
+    cfile     = cache_file(data_dir, cache_dir=cache_dir)
+
+    # -- in-process and on-disk copies are valid while the directory is unchanged
+    if not refresh:
+        man = _CACHE.get(data_dir)
+
+        if man is not None and man.dir_mtime == dir_mtime:
+            return man
+
+        if os.path.isfile(cfile):
+            npz = np.load(cfile)
+
+            if float(npz['dir_mtime']) == dir_mtime:
+                man = NightManifest(data_dir, dir_mtime, npz['fnames'], npz['sizes'], npz['mtimes'])
+                _CACHE[data_dir] = man
+
+                return man
+
+    # -- (re)scan the night
+    fnames = sorted(os.listdir(data_dir))
+    stats  = [os.stat(os.path.join(data_dir, i)) for i in fnames]
+    man    = NightManifest(data_dir, dir_mtime, np.array(fnames),
+                           np.array([st.st_size for st in stats], dtype=np.int64),
+                           np.array([st.st_mtime for st in stats], dtype=np.float64))
+
+    if not os.path.exists(os.path.dirname(cfile)):
+        os.makedirs(os.path.dirname(cfile))
+
+    with open(cfile + '.tmp', 'wb') as f:
+        np.savez(f, dir_mtime=dir_mtime, fnames=man.fnames, sizes=man.sizes, mtimes=man.mtimes)
+
+    os.rename(cfile + '.tmp', cfile)
+
+    _CACHE[data_dir] = man
+
+    return man
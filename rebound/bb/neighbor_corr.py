@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+def _tile_corr(cube, r0, r1, corr_r, corr_c, tchunk):
+    """
+    Accumulate the down/right neighbor products of rows [r0, r1) into
+    corr_r and corr_c, using one halo row below the band for corr_r.
+    """
+
+    nrow = cube.shape[1]
+    rh   = min(r1 + 1, nrow)
+
+    for t0 in range(0, cube.shape[0], tchunk):
+        sub = cube[t0:t0 + tchunk, r0:rh, :]
+
+        corr_r[r0:rh - 1] += (sub[:, :-1, :] * sub[:, 1:, :]).sum(0, dtype=np.float64)
+        corr_c[r0:r1] += (sub[:, :r1 - r0, :-1] * sub[:, :r1 - r0, 1:]).sum(0, dtype=np.float64)
+
+
+def neighbor_corr(cube, nthreads=None, tile_rows=128, tchunk=64):
+    """
+    Mean product of each pixel with its down and right neighbor over the
+    first axis of a standardized cube, i.e. the neighbor correlation
+    coefficients used for source extraction.
+
+    The image is split into bands of tile_rows rows (plus a one-row halo)
+    that are reduced in a thread pool, tchunk images at a time, so
+    temporaries stay tile-sized and the work scales with the number of
+    cores (numpy releases the GIL in the products and sums).
+
+    Parameters
+    ----------
+    cube : ndarray
+        Standardized data cube (nobs x nrows x ncols).
+    nthreads : int, optional
+        Number of threads (default all cores).
+    tile_rows : int, optional
+        Number of rows in a band.
+    tchunk : int, optional
+        Number of images multiplied at once within a band.
+
+    Returns
+    -------
+    corr_r, corr_c : ndarray
+        Correlation with the down (nrows-1 x ncols) and right
+        (nrows x ncols-1) neighbor.
+    """
+
+    nobs, nrow, ncol = cube.shape
+
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+
+    corr_r = np.zeros((nrow - 1, ncol))
+    corr_c = np.zeros((nrow, ncol - 1))
+
+    # -- bands write disjoint rows of the outputs, so no locking is needed
+    bands = [(r0, min(r0 + tile_rows, nrow)) for r0 in range(0, nrow, tile_rows)]
+
+    pool = ThreadPool(nthreads)
+    pool.map(lambda b: _tile_corr(cube, b[0], b[1], corr_r, corr_c, tchunk), bands)
+    pool.close()
+    pool.join()
+
+    corr_r /= nobs
+    corr_c /= nobs
+
+    return corr_r, corr_c
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import numpy as np
+import bb_settings
+import events
+
+
+class NightlyStats(object):
+    """
+    Per-night, per-source summary of the on/off transitions of a season.
+
+    All attributes are (nnights x nsources) arrays.
+
+    Attributes
+    ----------
+    duration : ndarray
+        Number of observations on, following duration.calc_dur (each off
+        closes the time since the last off or the first on after it).
+    first_on : ndarray
+        Index of the first on transition (-1 if none).
+    last_off : ndarray
+        Index of the last off transition (-1 if none).
+    transitions : ndarray
+        Number of on and off transitions.
+    longest : ndarray
+        Longest single on period (in observations).
+    """
+
+    names = ('duration', 'first_on', 'last_off', 'transitions', 'longest')
+
+    def __init__(self, duration, first_on, last_off, transitions, longest):
+
+        self.duration    = duration
+        self.first_on    = first_on
+        self.last_off    = last_off
+        self.transitions = transitions
+        self.longest     = longest
+
+    def subset(self, sources):
+        """
+        Statistics of a subset of sources (columns).
+        """
+
+        return NightlyStats(*[getattr(self, i)[:, sources] for i in self.names])
+
+    def save(self, fname, key=''):
+        """
+        Write the table as an .npz file (key identifies the inputs).
+        """
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, key=key, **dict((i, getattr(self, i)) for i in self.names))
+
+        os.rename(fname + '.tmp', fname)
+
+
+def event_stats(group, idx, kind, ngroup):
+    """
+    Nightly statistics from a list of transitions in one pass over the
+    events, vectorized across all (night, source) groups.
+
+    Parameters
+    ----------
+    group : ndarray
+        Group (night * nsources + source) of each event.
+    idx : ndarray
+        Observation index of each event.
+    kind : ndarray
+        events.ON or events.OFF (an on and an off at the same observation
+        cancel, as in duration.calc_dur).
+    ngroup : int
+        Number of groups.
+
+    Returns
+    -------
+    tuple of ndarray
+        duration, first_on, last_off, transitions and longest, each (ngroup).
+    """
+
+    group = np.asarray(group, dtype=np.int64)
+    idx   = np.asarray(idx, dtype=np.int64)
+    kind  = np.asarray(kind, dtype=np.int64)
+
+    # -- net event per (group, observation), sorted by group then time
+    order = np.lexsort((idx, group))
+    group, idx, kind = group[order], idx[order], kind[order]
+
+    start = np.ones(group.size, dtype=bool)
+    start[1:] = (group[1:] != group[:-1]) | (idx[1:] != idx[:-1])
+    net   = np.add.reduceat(kind, np.flatnonzero(start)) if group.size else kind
+    group, idx = group[start], idx[start]
+
+    keep = net != 0
+    group, idx, net = group[keep], idx[keep], net[keep]
+    on, off = net > 0, net < 0
+
+    # -- an on only (re)starts a period if the previous event was not an on
+    first = np.ones(group.size, dtype=bool)
+    first[1:] = group[1:] != group[:-1]
+    prev_on = np.zeros(group.size, dtype=bool)
+    prev_on[1:] = on[:-1]
+    eff = off | (on & (first | ~prev_on))
+
+    # -- index of the last effective event before each event (0 if none)
+    big  = idx.max() + 1 if idx.size else 1
+    run  = np.maximum.accumulate(np.where(eff, group * big + idx, -1)) if idx.size else idx
+    prev = np.full(group.size, -1, dtype=np.int64)
+    prev[1:] = run[:-1]
+    since = np.where(prev >= group * big, prev - group * big, 0)
+
+    period = np.where(off, idx - since, 0)
+
+    duration = np.bincount(group, weights=period, minlength=ngroup)
+    longest  = np.zeros(ngroup, dtype=np.int64)
+    np.maximum.at(longest, group, period)
+
+    first_on = np.full(ngroup, big, dtype=np.int64)
+    np.minimum.at(first_on, group[on], idx[on])
+    first_on[first_on == big] = -1
+
+    last_off = np.full(ngroup, -1, dtype=np.int64)
+    np.maximum.at(last_off, group[off], idx[off])
+
+    transitions = np.bincount(group, minlength=ngroup)
+
+    return duration, first_on, last_off, transitions, longest
+
+
+def from_dense(ons, offs):
+    """
+    Nightly statistics of dense on/off arrays, (nnights x nobs x nsources)
+    or (nobs x nsources) for a single night.
+    """
+
+    ons, offs = np.asarray(ons, dtype=bool), np.asarray(offs, dtype=bool)
+
+    if ons.ndim == 2:
+        ons, offs = ons[np.newaxis], offs[np.newaxis]
+
+    nnights, _, nsrc = ons.shape
+
+    on_n, on_i, on_s    = np.nonzero(ons)
+    off_n, off_i, off_s = np.nonzero(offs)
+
+    group = np.concatenate([on_n * nsrc + on_s, off_n * nsrc + off_s])
+    idx   = np.concatenate([on_i, off_i])
+    kind  = np.concatenate([np.full(on_i.size, events.ON), np.full(off_i.size, events.OFF)])
+
+    stats = event_stats(group, idx, kind, nnights * nsrc)
+
+    return NightlyStats(*[i.reshape(nnights, nsrc) for i in stats])
+
+
+def from_events(evts):
+    """
+    Nightly statistics of a list of events.EdgeEvents (one per night).
+    """
+
+    nsrc  = evts[0].nsrc
+    group = np.concatenate([n * nsrc + ev.src.astype(np.int64) for n, ev in enumerate(evts)])
+    idx   = np.concatenate([ev.idx for ev in evts])
+    kind  = np.concatenate([ev.kind for ev in evts])
+
+    stats = event_stats(group, idx, kind, len(evts) * nsrc)
+
+    return NightlyStats(*[i.reshape(len(evts), nsrc) for i in stats])
+
+
+def load(edge_dir=None, cache_dir=None, refresh=False):
+    """
+    Nightly statistics of every night in an edge directory, cached on disk
+    until an edge file is added, removed or modified.
+
+    Parameters
+    ----------
+    edge_dir : str, optional
+        Directory of edge event tables (.npz) or legacy edge pickles
+        (default bb_settings.EDGE_PATH).
+    cache_dir : str, optional
+        Directory of the cached table (default $REBOUND_WRITE/stats).
+    refresh : bool, optional
+        Force recomputation.
+
+    Returns
+    -------
+    NightlyStats
+        The statistics, nights in sorted file order.
+    """
+
+    edge_dir  = bb_settings.EDGE_PATH if edge_dir is None else edge_dir
+    cache_dir = os.path.join(os.environ['REBOUND_WRITE'], 'stats') if cache_dir is None \
+        else cache_dir
+
+    fnames = sorted(os.listdir(edge_dir))
+    key    = hashlib.md5(';'.join('{}:{}'.format(i, os.path.getmtime(os.path.join(edge_dir, i)))
+                                  for i in fnames)).hexdigest()
+    cfile  = os.path.join(cache_dir, 'nightly_{}.npz'.format(
+        hashlib.md5(os.path.abspath(edge_dir)).hexdigest()))
+
+    if not refresh and os.path.isfile(cfile):
+        npz = np.load(cfile)
+
+        if str(npz['key']) == key:
+            return NightlyStats(*[npz[i] for i in NightlyStats.names])
+
+    # -- one pass over each night's events
+    evts = []
+
+    for i in fnames:
+        fname = os.path.join(edge_dir, i)
+
+        if fname.endswith('.npz'):
+            evts.append(events.load(fname))
+        else:
+            ons, offs, tstamps = events.load_onoff(fname)
+            evts.append(events.from_dense(ons, offs, np.zeros(ons.shape, dtype=np.float32), tstamps))
+
+    stats = from_events(evts)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    stats.save(cfile, key)
+
+    return stats
@@ -4,6 +4,7 @@
 import os
 import numpy as np
 import matplotlib.pyplot as plt
+import labelindex
 
 
 def plot_image(img, clim=None, oname=None):
@@ -34,16 +35,19 @@ def plot_image(img, clim=None, oname=None):
     return
 
 
-def quick_source_info(labeled_mask, clim=None, oname=None):
+def quick_source_info(labeled_mask, clim=None, oname=None, index=None):
     """
     Plots a mask and upon mouse hover, sets plot title to: 
         pixel row,col; 
         light source label;
         light source size.
+
+    index is the labelindex.LabelIndex of the mask (built if None).
     """
 
     # utils
-    unique, size = np.unique(labeled_mask, return_counts=True)
+    if index is None:
+        index = labelindex.from_mask(labeled_mask)
 
     def print_label(event):
         if event.inaxes == ax:
@@ -51,7 +55,7 @@ def quick_source_info(labeled_mask, clim=None, oname=None):
             cind = int(event.xdata)
 
             ax.set_title("Pixel: ({},{}) | Light Source #: {} | Source Pixel Size: {}".format(
-                rind, cind, labeled_mask[rind, cind], size[labeled_mask[rind, cind]]))
+                rind, cind, labeled_mask[rind, cind], index.size_of(labeled_mask[rind, cind])))
 
             fig.canvas.draw()
 
@@ -3,10 +3,12 @@
 
 import os
 import time
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.ndimage as nd
 import scipy.ndimage.measurements as spm
+from scipy.spatial import cKDTree
 # import uo_tools as ut
 # from cuip.cuip.utils.misc import get_files
 
@@ -35,9 +37,10 @@ def store_offsets(path, ref):
 
 
 
-def locate_sources(img):
+def locate_sources(img, sizes=False):
     """
-    Extract sources from an image.
+    Extract sources from an image (optionally also returning their sizes
+    in pixels).
     """
 
     # -- get average intensity of pixels across rgb channels
@@ -60,8 +63,13 @@ def locate_sources(img):
     ind = (lsz > 25.) & (lsz < 500.) 
 
     # -- get center of masses for all the labelled sources in the image
-    return np.array(spm.center_of_mass(thr, labs[0], 
-                                       np.arange(1, labs[1]+1)[ind])).T
+    rr, cc = np.array(spm.center_of_mass(thr, labs[0], 
+                                         np.arange(1, labs[1]+1)[ind])).reshape(-1, 2).T
+
+    if sizes:
+        return rr, cc, lsz[ind]
+
+    return rr, cc
 
 
 def get_catalog(ref="dobler2015_alt2"):
@@ -182,16 +190,260 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat):
     return good0126
 
 
-def register(img, ref="dobler2015_alt2"):
+def solve_transform(rr_cat, cc_cat, rr_img, cc_img, shape):
+    """
+    Least-squares offset and rotation (about the image center) between
+    matched catalog and image positions.
+
+    Parameters
+    ----------
+    rr_cat, cc_cat : ndarray
+        Row/col positions of the catalog sources.
+    rr_img, cc_img : ndarray
+        Row/col positions of the matching image sources.
+    shape : tuple
+        Shape of the image.
+
+    Returns
+    -------
+    tuple
+        Row offset, column offset and rotation (degrees) that register the
+        image *to* the catalog.
+    """
+
+    # -- get positions of image sources and catalog sources to know the quadrant they occupy
+    roff  = shape[0] // 2
+    coff  = shape[1] // 2
+    rrr0  = np.asarray(rr_cat, dtype=float) - roff
+    rrr1  = np.asarray(rr_img, dtype=float) - roff
+    ccc0  = np.asarray(cc_cat, dtype=float) - coff
+    ccc1  = np.asarray(cc_img, dtype=float) - coff
+
+    # -- get the matrix for catalog sources
+    mones      = np.zeros(rrr0.size*2+1)
+    mones[::2] = 1.0
+
+    pm         = np.zeros([rrr0.size*2,4])
+    pm[::2,0]  = rrr0
+    pm[1::2,0] = ccc0
+    pm[::2,1]  = -ccc0
+    pm[1::2,1] = rrr0
+    pm[:,2]    = mones[:-1]
+    pm[:,3]    = mones[1:]
+
+    # -- get the matrix for image sources
+    bv         = np.zeros([rrr0.size*2])
+    bv[::2]    = rrr1
+    bv[1::2]   = ccc1
+
+    # -- calculating rotation of image 
+    pmTpm = np.dot(pm.T, pm)
+    av    = np.dot(np.linalg.inv(pmTpm), np.dot(pm.T, bv))
+
+    dr, dc = av[-2:]
+    dtheta = np.arctan2(av[1],av[0]) * 180. / np.pi
+
+    return -dr, -dc, -dtheta # minus sign registers *to* the catalog
+
+
+def transform_residuals(rr_cat, cc_cat, rr_img, cc_img, shape, params):
+    """
+    Distances between image positions and the catalog positions moved by
+    the rotation and offset (no scaling) that params register away, with
+    params as returned by solve_transform.
+    """
+
+    dr, dc, dtheta = params
+    roff  = shape[0] // 2
+    coff  = shape[1] // 2
+    zcat  = (np.asarray(rr_cat, dtype=float) - roff) + 1j * (np.asarray(cc_cat, dtype=float) - coff)
+    zimg  = (np.asarray(rr_img, dtype=float) - roff) + 1j * (np.asarray(cc_img, dtype=float) - coff)
+
+    return np.abs(np.exp(-1j * dtheta * np.pi / 180.) * zcat - dr - 1j * dc - zimg)
+
+
+def triangle_hashes(rr, cc, tri):
+    """
+    Scale and rotation invariant hashes of triangles of sources.
+
+    The vertices of each triangle are ordered by increasing length of the
+    opposite side and the hash is the ratio of the two shorter sides to
+    the longest one.
+
+    Parameters
+    ----------
+    rr, cc : ndarray
+        Row/col positions of the sources.
+    tri : ndarray
+        Source indices of the triangles (ntri x 3).
+
+    Returns
+    -------
+    tuple
+        Hashes (ntri x 2) and the reordered triangles (ntri x 3).
+    """
+
+    pos  = rr[tri] + 1j * cc[tri]
+    side = np.abs(pos[:, [1, 2, 0]] - pos[:, [2, 0, 1]]) # -- opposite each vertex
+
+    order = side.argsort(1)
+    side  = np.take_along_axis(side, order, 1)
+    tri   = np.take_along_axis(tri, order, 1)
+    side[side[:, 2] == 0, 2] = 1.0
+
+    return side[:, :2] / side[:, 2:], tri
+
+
+def hash_match(rr1, cc1, rr_cat, cc_cat, sizes=None, nmax=40, eps=0.02, tol=10.,
+               max_rot=20., max_scale=0.05, max_shift=200., min_frac=0.6, shape=None):
+    """
+    Match image sources to the catalog with triangle hashes.
+
+    Triangles of the catalog and of the nmax largest image sources are
+    matched on their hashes with a KD-tree, each candidate match defines a
+    similarity transform that is verified by counting the catalog sources
+    it maps to within tol of an image source (among all image sources),
+    and the best candidate (of those without large rotations, scalings or
+    offsets) is kept.  It is only returned if it matches
+    more than min_frac of the catalog (and at least 4 sources) and the
+    matches are still within tol once refitted with solve_transform, so
+    that an image whose catalog sources are not among the nmax largest
+    gives no match rather than a wrong one.
+
+    Parameters
+    ----------
+    rr1, cc1 : ndarray
+        Row/col positions of the image sources.
+    rr_cat, cc_cat : ndarray
+        Row/col positions of the catalog sources.
+    sizes : ndarray, optional
+        Sizes of the image sources used to choose the nmax largest (the
+        first nmax if None).
+    nmax : int, optional
+        Number of image sources used to build triangles.
+    eps : float, optional
+        Matching tolerance of the hashes.
+    tol : float, optional
+        Matching tolerance of the positions (pixels).
+    max_rot : float, optional
+        Maximum rotation (degrees) between the catalog and the image.
+    max_scale : float, optional
+        Maximum relative scaling between the catalog and the image.
+    max_shift : float, optional
+        Maximum offset (pixels) of the image center.
+    min_frac : float, optional
+        Minimum fraction of the catalog that must be matched.
+    shape : tuple, optional
+        Shape of the image (the extent of the image sources if None).
+
+    Returns
+    -------
+    tuple
+        Indices of the matched catalog sources and of the corresponding
+        image sources (empty if there is no match).
+    """
+
+    rr1, cc1 = np.asarray(rr1, dtype=float), np.asarray(cc1, dtype=float)
+    rr_cat, cc_cat = np.asarray(rr_cat, dtype=float), np.asarray(cc_cat, dtype=float)
+    none = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    if shape is None:
+        shape = (int(rr1.max()) + 1, int(cc1.max()) + 1)
+
+    # -- brightest (largest) image sources
+    top = np.arange(rr1.size) if sizes is None else np.argsort(sizes)[::-1]
+    top = top[:nmax]
+
+    if top.size < 3:
+        return none
+
+    # -- hashes of all triangles
+    ctri = np.array(list(itertools.combinations(range(rr_cat.size), 3)))
+    itri = top[np.array(list(itertools.combinations(range(top.size), 3)))]
+    chsh, ctri = triangle_hashes(rr_cat, cc_cat, ctri)
+    ihsh, itri = triangle_hashes(rr1, cc1, itri)
+
+    # -- candidate triangle pairs
+    pairs = cKDTree(ihsh).query_ball_point(chsh, eps)
+    cind  = np.repeat(np.arange(len(pairs)), [len(i) for i in pairs])
+    iind  = np.array([j for i in pairs for j in i], dtype=int)
+
+    if iind.size == 0:
+        return none
+
+    # -- similarity transform (image = a * catalog + b, complex positions)
+    # -- of each candidate
+    zcat = rr_cat + 1j * cc_cat
+    zimg = rr1 + 1j * cc1
+    zc   = zcat[ctri[cind]]
+    zi   = zimg[itri[iind]]
+    zc  -= zc.mean(1, keepdims=True)
+    aa   = (zi * zc.conj()).sum(1) / (np.abs(zc)**2).sum(1)
+    bb   = zi.mean(1) - aa * zcat[ctri[cind]].mean(1)
+
+    # -- reject large rotations, scalings and offsets
+    zmid = shape[0] // 2 + 1j * (shape[1] // 2)
+    good = (np.abs(np.angle(aa)) < max_rot * np.pi / 180.) & \
+        (np.abs(np.abs(aa) - 1) < max_scale) & (np.abs((aa - 1) * zmid + bb) < max_shift)
+    aa, bb = aa[good], bb[good]
+
+    if aa.size == 0:
+        return none
+
+    # -- verify against all image sources
+    proj = aa[:, np.newaxis] * zcat + bb[:, np.newaxis]
+    dist, near = cKDTree(np.array([rr1, cc1]).T).query(
+        np.array([proj.real.ravel(), proj.imag.ravel()]).T)
+    dist = dist.reshape(proj.shape)
+    near = near.reshape(proj.shape)
+    hit  = dist < tol
+
+    # -- most matched sources, then smallest residual
+    score = hit.sum(1) - np.where(hit, dist, 0).sum(1) / (tol * (hit.sum(1) + 1))
+    best  = score.argmax()
+    icat  = np.flatnonzero(hit[best])
+    iimg  = near[best][hit[best]]
+
+    # -- require most of the catalog, each on a distinct image source
+    if np.unique(iimg).size <= max(min_frac * rr_cat.size, 3):
+        return none
+
+    # -- the transform register solves for must still fit every match
+    params = solve_transform(rr_cat[icat], cc_cat[icat], rr1[iimg], cc1[iimg], shape)
+
+    if (transform_residuals(rr_cat[icat], cc_cat[icat], rr1[iimg], cc1[iimg], shape,
+                            params) >= tol).any():
+        return none
+
+    return icat, iimg
+
+
+def register(img, ref="dobler2015_alt2", method="quads", **kwargs):
     """
     Register an image to the catalog.
+
+    method is either "quads" (distance matching of the catalog sources 0,
+    1, 2 and 6) or "hash" (triangle hash matching of all catalog sources,
+    see hash_match, which takes the keyword arguments).
     """
 
     # -- extract sources
-    rr1, cc1 = locate_sources(img)
+    rr1, cc1, lsz = locate_sources(img, sizes=True)
 
-    # -- get the catalog positions and distances (squared)
+    # -- get the catalog positions
     rr_cat, cc_cat = get_catalog(ref=ref)
+
+    if method == "hash":
+        icat, iimg = hash_match(rr1, cc1, rr_cat, cc_cat, sizes=lsz, shape=img.shape[:2],
+                                **kwargs)
+
+        if icat.size == 0:
+            raise ValueError("no catalog match found")
+
+        return solve_transform(rr_cat[icat], cc_cat[icat], rr1[iimg], cc1[iimg], 
+                               img.shape)
+
+    # -- get the catalog distances
     dcat  = np.sqrt(((rr_cat[0] - rr_cat)**2 + (cc_cat[0] - cc_cat)**2)[1:])
     dcatm = np.sqrt((rr_cat[:, np.newaxis] - rr_cat)**2 + 
                     (cc_cat[:,np.newaxis] - cc_cat)**2)
@@ -221,39 +473,7 @@ def register(img, ref="dobler2015_alt2"):
     rrr0, ccc0 = rr_cat[np.array([0, 1, 2, 6])], cc_cat[np.array([0, 1, 2, 6])]
     rrr1, ccc1 = rr1[guess], cc1[guess]
     
-    # -- get positions of image sources and catalog sources to know the quadrant they occupy
-    roff  = img.shape[0] // 2
-    coff  = img.shape[1] // 2
-    rrr0 -= roff
-    rrr1 -= roff
-    ccc0 -= coff
-    ccc1 -= coff
-
-    # -- get the matrix for catalog sources
-    mones      = np.zeros(rrr0.size*2+1)
-    mones[::2] = 1.0
-
-    pm         = np.zeros([rrr0.size*2,4])
-    pm[::2,0]  = rrr0
-    pm[1::2,0] = ccc0
-    pm[::2,1]  = -ccc0
-    pm[1::2,1] = rrr0
-    pm[:,2]    = mones[:-1]
-    pm[:,3]    = mones[1:]
-
-    # -- get the matrix for image sources
-    bv         = np.zeros([rrr0.size*2])
-    bv[::2]    = rrr1
-    bv[1::2]   = ccc1
-
-    # -- calculating rotation of image 
-    pmTpm = np.dot(pm.T, pm)
-    av    = np.dot(np.linalg.inv(pmTpm), np.dot(pm.T, bv))
-
-    dr, dc = av[-2:]
-    dtheta = np.arctan2(av[1],av[0]) * 180. / np.pi
-
-    return -dr, -dc, -dtheta # minus sign registers *to* the catalog
+    return solve_transform(rrr0, ccc0, rrr1, ccc1, img.shape)
 
 
 
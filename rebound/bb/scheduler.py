@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import traceback
+import multiprocessing
+
+
+def night_key(night):
+    """
+    Return the manifest key of a night, either a (month, night) tuple or an
+    "MM_DD" string.
+    """
+
+    if isinstance(night, basestring):
+        return night
+
+    return '{}_{}'.format(*night)
+
+
+def load_manifest(fname):
+    """
+    Read a night manifest (dict with "done" list and "failed" dict of
+    night key -> last error).  Returns an empty manifest if fname does not
+    exist.
+    """
+
+    if fname is None or not os.path.isfile(fname):
+        return {"done": [], "failed": {}}
+
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(fname, manifest):
+    """
+    Atomically write a night manifest so a crash never leaves it truncated.
+    """
+
+    if fname is None:
+        return
+
+    tmp = fname + '.tmp'
+
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.rename(tmp, fname)
+
+
+def pool_size(nproc=None, mem_budget=None, mem_per_night=None):
+    """
+    Number of worker processes: nproc (default all cores), reduced so that
+    nproc * mem_per_night fits within mem_budget (both in bytes).
+    """
+
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    if mem_budget is not None and mem_per_night is not None:
+        nproc = min(nproc, int(mem_budget // mem_per_night))
+
+    return max(nproc, 1)
+
+
+def _run_one(func, night, kwargs):
+    """
+    Worker wrapper: run func on a night and return (key, error or None)
+    rather than raising, so one bad night cannot abort the pool.
+    """
+
+    try:
+        func(night, **kwargs)
+        return night_key(night), None
+
+    except Exception:
+        return night_key(night), traceback.format_exc()
+
+
+def _run_star(args):
+    """
+    Single-argument form of _run_one for Pool.imap_unordered.
+    """
+
+    return _run_one(*args)
+
+
+def run_nights(func, nights, manifest=None, nproc=None, mem_budget=None,
+               mem_per_night=None, retries=1, retry_failed=False, **kwargs):
+    """
+    Run a per-night processing function over a list of nights on a process
+    pool, recording finished nights in a manifest so reruns skip them.
+
+    Parameters
+    ----------
+    func : function
+        Module-level function called as func(night, **kwargs).
+    nights : list
+        Nights as (month, night) tuples or "MM_DD" strings.
+    manifest : str, optional
+        Path of the JSON manifest of finished and quarantined nights.
+    nproc : int, optional
+        Maximum number of worker processes (default all cores).  With 1,
+        nights are run in this process.
+    mem_budget, mem_per_night : int, optional
+        Total memory budget and estimated peak memory of one night (bytes);
+        caps the pool size.
+    retries : int, optional
+        Number of times a failed night is resubmitted before it is
+        quarantined.
+    retry_failed : bool, optional
+        If True, also rerun nights quarantined by a previous run.
+
+    Returns
+    -------
+    dict
+        The final manifest.
+    """
+
+    start = time.time()
+
+    # -- skip nights that are already done (or quarantined)
+    man  = load_manifest(manifest)
+    skip = set(man["done"])
+    if not retry_failed:
+        skip.update(man["failed"].keys())
+
+    todo   = [n for n in nights if night_key(n) not in skip]
+    lookup = dict((night_key(n), n) for n in todo)
+    tries  = dict((k, 0) for k in lookup)
+
+    print("{} nights to run, {} skipped from manifest..." \
+              .format(len(todo), len(nights) - len(todo)))
+
+    nproc = min(pool_size(nproc, mem_budget, mem_per_night), max(len(todo), 1))
+    pool = multiprocessing.Pool(nproc) if nproc > 1 else None
+
+    # -- workers are killed if the loop is interrupted (or saving fails)
+    finished = False
+
+    try:
+        while todo:
+            # -- results arrive as nights finish, so the manifest is always current
+            if pool is None:
+                results = (_run_one(func, n, kwargs) for n in todo)
+            else:
+                results = pool.imap_unordered(_run_star,
+                                              [(func, n, kwargs) for n in todo])
+
+            todo = []
+
+            for key, err in results:
+                tries[key] += 1
+
+                if err is None:
+                    man["done"].append(key)
+                    man["failed"].pop(key, None)
+                    print("finished {}".format(key))
+
+                elif tries[key] <= retries:
+                    print("{} failed, retrying...\n{}".format(key, err))
+                    todo.append(lookup[key])
+
+                else:
+                    man["failed"][key] = err
+                    print("{} failed, quarantined...\n{}".format(key, err))
+
+                save_manifest(manifest, man)
+
+        finished = True
+
+    finally:
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    print("Total runtime for all nights: {}".format(time.time() - start))
+
+    return man
@@ -6,6 +6,8 @@ import os
 import time
 import random
 import bb_settings
+import manifest
+from neighbor_corr import neighbor_corr
 import matplotlib.pyplot as plt
 from scipy.ndimage.filters import gaussian_filter as gf
 from scipy.ndimage import measurements as mm
@@ -17,6 +19,78 @@ from scipy.ndimage import measurements as mm
 # IMG_SHAPE = (3072, 4096)  # dimensions of BK raw images
 
 
+def brightness_profile(data_dir, sh=bb_settings.IMG_SHAPE, row_step=32, col_step=8):
+    '''
+    Mean luminosity of every image of a night, estimated from a strided
+    subsample of pixels (every row_step-th row, so only those rows are read
+    from disk).  The profile is cached next to the night's manifest and
+    reused until the night directory changes.
+
+    Parameters:
+    ___________
+    data_dir = str
+        sub-directory filepath of night containing raw image files
+
+    row_step, col_step = int (default 32, 8)
+        sampling of rows and columns
+
+    Returns:
+    ________
+    lum_means = 1-d numpy array
+        mean luminosity of each image (nobs)
+    '''
+    man = manifest.scan(data_dir)
+    cfile = manifest.cache_file(data_dir, 'brightness')
+
+    if os.path.isfile(cfile):
+        npz = np.load(cfile)
+
+        if float(npz['dir_mtime']) == man.dir_mtime and tuple(npz['steps']) == (row_step, col_step):
+            return npz['lum_means']
+
+    lum_means = np.empty(len(man), dtype=np.float32)
+
+    for ii, i in enumerate(man.paths()):
+        img = np.memmap(i, dtype=np.uint8, mode='r', shape=(sh[0], sh[1]))
+        lum_means[ii] = img[::row_step, ::col_step].mean()
+
+    with open(cfile + '.tmp', 'wb') as f:
+        np.savez(f, dir_mtime=man.dir_mtime, steps=(row_step, col_step), lum_means=lum_means)
+
+    os.rename(cfile + '.tmp', cfile)
+
+    return lum_means
+
+
+def daylight_bounds(data_dir, margin=0):
+    '''
+    Analytic start and stop indices of the dark part of a night, from the
+    cached brightness profile of every image: images brighter than the
+    median of the whole profile + 0.5 are daylight.  Unlike
+    truncate_daylight, the profile is not subsampled by daylight_step, so
+    the bounds are exact to the image.
+
+    Parameters:
+    ___________
+    data_dir = str
+        sub-directory filepath of night containing raw image files
+
+    margin = int (default 0)
+        number of dark images dropped at each end
+
+    Returns:
+    ________
+    file_start,file_stop
+        first dark image + margin, and one past the last dark image - margin
+        (exclusive, as used for file_stop)
+    '''
+    lum_means = brightness_profile(data_dir)
+
+    dark = np.where(lum_means < np.median(lum_means)+0.5)[0]
+
+    return dark[0]+margin, dark[-1]+1-margin
+
+
 def truncate_daylight(data_dir, daylight_step, plot):
     '''
     Extract files and plots avg luminosity. Assumes Brooklyn data.
@@ -48,12 +122,8 @@ def truncate_daylight(data_dir, daylight_step, plot):
 
     if plot = True, draws plot
     '''
-    lum_list = []
-
-    for i in sorted(os.listdir(data_dir))[::daylight_step]:
-        lum_list.append(np.memmap(os.path.join(
-            data_dir, i), dtype=np.uint8, mode='r'))
-        lum_means = np.array(lum_list, dtype=np.float32).mean(1)
+    # per-image luminosity from the cached, subsampled brightness profile
+    lum_means = brightness_profile(data_dir)[::daylight_step]
 
     if not plot:  # crude analytical method
         thresh = np.median(lum_means)+0.5
@@ -102,66 +172,38 @@ def truncate_daylight(data_dir, daylight_step, plot):
         return
 
 
-def create_mask(nights, directory=bb_settings.DATA_FILEPATH, output=None, 
-    sh=bb_settings.IMG_SHAPE, step=5, multi=False, file_start=100, file_stop=2700, thresh=0.5, gfilter=None):
+def load_cube(nights, directory, sh, step, multi, file_start, file_stop, gfilter, daylight=False):
     '''
-    Converts a series of raw images into a 2-D boolean mask array
-    that indicates pixels that are highly correlated based on 
-    changes in luminosity over time with their
-    neighbors to the left or right, or above or below.
-    Assumes Brooklyn data, i.e. raw files are 3072 by 4096 and in monochrome8 format
-
-    Parameters:
-    ___________
-    DATA_FILEPATH= str
-        full filepath of directory that contains subdirectoris of months
-
-    nights = list of tuples of str ('06','25')
-        sub-directory of (months,nights) containing raw image files
-        - requires RBG format
-
-    step = int (default 6)
-        indicates step size when iterating through files in data_dir
-
-    thresh = float (default .50)
-        threshold correlation coefficient value, below which all pixels are masked
-
-    file_start = int (default 100)
-        index of files in source directory to start loading 
-
-    file_stop = int (default 2700)
-        index of files in source directory to stop loading
-
-    gf = int (default None)
-        if not None, implements a gaussian filter pass with sigma for time dimension set at this value
-
+    Loads the raw images of each night and standardizes each pixel time series
+    per night (see create_mask for parameters).
 
     Returns:
     ________
-    mask = 2-d numpy array
-        boolean array that expresses true for coordinates of pixels that are correlated
-        with neighbors.
-
-    labels = 2-d numpy array
-        labels of pixels grouped in unique light sources as positioned (row,col) in original image
+    img_cube = 3-d numpy array
+        float32 cube of standardized images (nnights*nobs x nrows x ncols)
     '''
-    start_mask = time.time()
-
     # - utils
+    if daylight:
+        bounds = [daylight_bounds(os.path.join(directory, n[0], n[1])) for n in nights]
+    else:
+        bounds = [(file_start, file_stop)] * len(nights)
+
     if multi:
-        lnight = 250
+        lnights = [250] * len(nights)
     else:
-        lnight = len(np.arange(file_start, file_stop, step))
-    nnights = len(nights)
+        lnights = [len(np.arange(b[0], b[1], step)) for b in bounds]
 
     # initialize image time-series datacube,
     # with known dims if using default file_start/file_stop (i.e. night only
     # index)
-    img_cube = np.empty((nnights*lnight, sh[0], sh[1]), dtype=np.float32)
+    img_cube = np.empty((sum(lnights), sh[0], sh[1]), dtype=np.float32)
     idx = 0
 
     # -- load files for each select night and standardize
-    for night in nights:
+    for night, bound, lnight in zip(nights, bounds, lnights):
+
+        if daylight:
+            file_start, file_stop = bound
 
         # initialize night cube
         imgs = np.empty((lnight, sh[0], sh[1]), dtype=np.float32)
@@ -177,9 +219,8 @@ def create_mask(nights, directory=bb_settings.DATA_FILEPATH, output=None,
             file_start = random.randint(file_start, file_stop-lnight)
             file_stop = file_start+lnight
 
-        for i in sorted(os.listdir(data_dir))[file_start:file_stop:step]:
-            imgs[nidx, :, :] = (np.fromfile(os.path.join(
-                data_dir, i), dtype=np.uint8).reshape(sh[0], sh[1])).astype(np.float32)
+        for i in manifest.scan(data_dir).paths(file_start, file_stop, step):
+            imgs[nidx, :, :] = (np.fromfile(i, dtype=np.uint8).reshape(sh[0], sh[1])).astype(np.float32)
             nidx += 1
 
         # standardize
@@ -207,14 +248,167 @@ def create_mask(nights, directory=bb_settings.DATA_FILEPATH, output=None,
 
         idx += imgs.shape[0]
 
-    time_loaded = time.time()
-    print('Time to load and standardize: {}'.format(time_loaded-start_mask))
+    return img_cube
+
+
+def night_corr(paths, sh):
+    '''
+    Single pass over the raw images of one night, keeping per-pixel running
+    sums of x, x^2 and x times its down and right neighbors.  Returns the
+    sums over frames of the products of the per-night standardized pixel
+    values (as in load_cube) for down and right neighbors, and the number
+    of frames, so that only a few full-frame accumulators are ever in memory.
+
+    Sums of uint8 products are exact in float64 for any realistic number of
+    frames.
+    '''
+    sx  = np.zeros(sh)
+    sxx = np.zeros(sh)
+    sxr = np.zeros((sh[0]-1, sh[1]))
+    sxc = np.zeros((sh[0], sh[1]-1))
+    nobs = 0
+
+    for i in paths:
+        img = np.fromfile(i, dtype=np.uint8).reshape(sh[0], sh[1]).astype(np.float64)
+
+        sx += img
+        sxx += img * img
+        sxr += img[:-1, :] * img[1:, :]
+        sxc += img[:, :-1] * img[:, 1:]
+        nobs += 1
+
+    # per-pixel mean and inverse standard deviation (0 for unchanging pixels,
+    # matching the nan -> 0 convention of load_cube)
+    mu = sx / nobs
+    sig = np.sqrt(np.maximum(sxx / nobs - mu**2, 0))
+    isig = np.divide(1.0, sig, out=np.zeros_like(sig), where=sig > 0)
+
+    # sum_t z_a z_b = (sum_t x_a x_b - n mu_a mu_b) / (sig_a sig_b)
+    corr_r = (sxr - nobs * mu[:-1, :] * mu[1:, :]) * isig[:-1, :] * isig[1:, :]
+    corr_c = (sxc - nobs * mu[:, :-1] * mu[:, 1:]) * isig[:, :-1] * isig[:, 1:]
+
+    return corr_r, corr_c, nobs
+
+
+def stream_corr(nights, directory, sh, step, multi, file_start, file_stop, daylight=False):
+    '''
+    Neighbor correlation coefficients for any number of nights, streaming
+    one image at a time through night_corr (see create_mask for parameters).
+
+    Returns:
+    ________
+    corr_r, corr_c = 2-d numpy arrays
+        correlation of each pixel with its down (nrows-1 x ncols) and right
+        (nrows x ncols-1) neighbor
+    '''
+    lnight = 250
+
+    corr_r = np.zeros((sh[0]-1, sh[1]))
+    corr_c = np.zeros((sh[0], sh[1]-1))
+    nobs = 0
+
+    for night in nights:
+        data_dir = os.path.join(directory, night[0], night[1])
+
+        print('Streaming images for {}...'.format(night))
+
+        if daylight:
+            file_start, file_stop = daylight_bounds(data_dir)
+
+        if multi:
+            file_start = random.randint(file_start, file_stop-lnight)
+            file_stop = file_start+lnight
+
+        cr, cc, n = night_corr(manifest.scan(data_dir).paths(file_start, file_stop, step), sh)
+
+        corr_r += cr
+        corr_c += cc
+        nobs += n
+
+    corr_r /= nobs
+    corr_c /= nobs
+
+    return corr_r, corr_c
+
+
+def create_mask(nights, directory=bb_settings.DATA_FILEPATH, output=None, 
+    sh=bb_settings.IMG_SHAPE, step=5, multi=False, file_start=100, file_stop=2700, thresh=0.5, gfilter=None, stream=False, nthreads=None, daylight=False):
+    '''
+    Converts a series of raw images into a 2-D boolean mask array
+    that indicates pixels that are highly correlated based on 
+    changes in luminosity over time with their
+    neighbors to the left or right, or above or below.
+    Assumes Brooklyn data, i.e. raw files are 3072 by 4096 and in monochrome8 format
+
+    Parameters:
+    ___________
+    DATA_FILEPATH= str
+        full filepath of directory that contains subdirectoris of months
+
+    nights = list of tuples of str ('06','25')
+        sub-directory of (months,nights) containing raw image files
+        - requires RBG format
+
+    step = int (default 6)
+        indicates step size when iterating through files in data_dir
+
+    thresh = float (default .50)
+        threshold correlation coefficient value, below which all pixels are masked
+
+    file_start = int (default 100)
+        index of files in source directory to start loading 
+
+    file_stop = int (default 2700)
+        index of files in source directory to stop loading
+
+    gf = int (default None)
+        if not None, implements a gaussian filter pass with sigma for time dimension set at this value
+
+    stream = boolean (default False)
+        if True, images are read one at a time into running per-pixel sums instead of a
+        (nnights*nobs x nrows x ncols) cube, so memory is independent of the number of
+        nights and frames (gfilter is not supported in this mode)
+
+    nthreads = int (default None)
+        number of threads used to compute the neighbor correlations of the cube
+        (default all cores)
+
+    daylight = boolean (default False)
+        if True, file_start and file_stop are replaced for each night by daylight_bounds()
+
+
+    Returns:
+    ________
+    mask = 2-d numpy array
+        boolean array that expresses true for coordinates of pixels that are correlated
+        with neighbors.
+
+    labels = 2-d numpy array
+        labels of pixels grouped in unique light sources as positioned (row,col) in original image
+    '''
+    start_mask = time.time()
+
+    if stream:
+        if gfilter is not None:
+            raise ValueError("gfilter needs the full time series and is not supported with stream=True")
+
+        img_cube = None
+        time_loaded = time.time()
+
+        print("Calculating correlation coefficients...")
+
+        corr_r, corr_c = stream_corr(nights, directory, sh, step, multi, file_start, file_stop, daylight)
+
+    else:
+        img_cube = load_cube(nights, directory, sh, step, multi, file_start, file_stop, gfilter, daylight)
+
+        time_loaded = time.time()
+        print('Time to load and standardize: {}'.format(time_loaded-start_mask))
 
-    print("Calculating correlation coefficients...")
+        print("Calculating correlation coefficients...")
 
-    # matrix mult to get horizontal and vertical correlation
-    corr_r = (img_cube[:, :-1, :] * img_cube[:, 1:, :]).mean(0)
-    corr_c = (img_cube[:, :, :-1] * img_cube[:, :, 1:]).mean(0)
+        # horizontal and vertical correlation, reduced in row bands across threads
+        corr_r, corr_c = neighbor_corr(img_cube, nthreads=nthreads)
 
     # Creating a mask for all the pixels/sources with correlation greater than
     # threshold
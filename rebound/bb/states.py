@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import cPickle as pickle
+
+# -- number of set bits and position of the first/last set bit (MSB first) of a byte
+POPCOUNT  = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+FIRST_BIT = np.array([8] + [8 - len(bin(i)[2:]) for i in range(1, 256)], dtype=np.int64)
+LAST_BIT  = np.array([-1] + [7 - (len(bin(i & -i)) - 3) for i in range(1, 256)], dtype=np.int64)
+
+
+class PackedStates(object):
+    """
+    Light on/off states of a season bit-packed along time, one bit per
+    (observation, source), with aggregates computed on the packed bytes.
+
+    Parameters
+    ----------
+    bits : ndarray
+        Packed states (nnights x nsources x ceil(nobs / 8)) uint8, the
+        first observation of a night in the most significant bit.
+    tstamps : ndarray
+        Timestamps of the observations (nnights x nobs).
+
+    Attributes
+    ----------
+    nnights, nsrc, nobs : int
+        Number of nights, sources and observations per night.
+    """
+
+    def __init__(self, bits, tstamps):
+
+        self.bits    = bits
+        self.tstamps = tstamps
+
+    @property
+    def nnights(self):
+        return self.bits.shape[0]
+
+    @property
+    def nsrc(self):
+        return self.bits.shape[1]
+
+    @property
+    def nobs(self):
+        return self.tstamps.shape[1]
+
+    def _bits(self, sources):
+        return self.bits if sources is None else self.bits[:, sources]
+
+    def unpack(self, sources=None):
+        """
+        Dense states in the layout of precision_stack.multi_night,
+        (nnights * nobs x nsources) bool.
+        """
+
+        bits   = self._bits(sources)
+        states = np.unpackbits(bits, axis=2)[:, :, :self.nobs].view(bool)
+
+        return states.transpose(0, 2, 1).reshape(-1, bits.shape[1])
+
+    def duration(self, sources=None, tstep=1.0):
+        """
+        Time on per night and source (number of on observations * tstep),
+        (nnights x nsources).
+        """
+
+        return POPCOUNT[self._bits(sources)].sum(2, dtype=np.int64) * tstep
+
+    def any_on(self, tmin, tmax, sources=None):
+        """
+        Whether each source is on at any observation with tmin < tstamp <
+        tmax (in any night), (nsources) bool.
+        """
+
+        bits = self._bits(sources)
+        out  = np.zeros(bits.shape[1], dtype=bool)
+
+        for n in range(self.nnights):
+            obs = np.flatnonzero((self.tstamps[n] > tmin) & (self.tstamps[n] < tmax))
+
+            if obs.size == 0:
+                continue
+
+            # -- bit mask of the window over the bytes it touches
+            lo, hi = obs[0] // 8, obs[-1] // 8 + 1
+            msk    = np.zeros((hi - lo) * 8, dtype=bool)
+            msk[obs - lo * 8] = True
+
+            out |= (bits[n, :, lo:hi] & np.packbits(msk)).any(1)
+
+        return out
+
+    def first_on(self, sources=None):
+        """
+        Index of the first on observation per night and source (-1 if
+        never on), (nnights x nsources).
+        """
+
+        bits  = self._bits(sources)
+        first = (bits != 0).argmax(2)
+        byte  = np.take_along_axis(bits, first[:, :, np.newaxis], 2)[:, :, 0]
+
+        return np.where(byte != 0, first * 8 + FIRST_BIT[byte], -1)
+
+    def last_on(self, sources=None):
+        """
+        Index of the last on observation per night and source (-1 if never
+        on), (nnights x nsources).
+        """
+
+        bits = self._bits(sources)
+        last = bits.shape[2] - 1 - (bits[:, :, ::-1] != 0).argmax(2)
+        byte = np.take_along_axis(bits, last[:, :, np.newaxis], 2)[:, :, 0]
+
+        return np.where(byte != 0, last * 8 + LAST_BIT[byte], -1)
+
+    def last_off(self, sources=None):
+        """
+        Index of the observation at which each source last turns off, i.e.
+        the observation after its last on one (nobs if still on at the end
+        of the night, -1 if never on), (nnights x nsources).
+        """
+
+        last = self.last_on(sources)
+
+        return np.where(last >= 0, last + 1, -1)
+
+    def save(self, fname):
+        """
+        Write the packed states to an .npz file.
+        """
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, bits=self.bits, tstamps=self.tstamps)
+
+        os.rename(fname + '.tmp', fname)
+
+
+def pack(states, nobs):
+    """
+    Pack a night-major boolean state array ((nnights * nobs) x nsources, or
+    nnights x nobs x nsources) along time into (nnights x nsources x
+    ceil(nobs / 8)) uint8.
+    """
+
+    states = np.asarray(states)
+    states = states.reshape(-1, nobs, states.shape[-1])
+
+    return np.packbits(states.transpose(0, 2, 1), axis=2)
+
+
+def from_states(states, tstamps, nobs):
+    """
+    Build PackedStates from a night-major boolean state array and its
+    (concatenated or per-night) timestamps.
+    """
+
+    return PackedStates(pack(states, nobs), np.asarray(tstamps).reshape(-1, nobs))
+
+
+def load(fname, nobs=2700):
+    """
+    Read PackedStates written by PackedStates.save, or pack a legacy
+    (states, tstamps) pickle of precision_stack.multi_night.
+    """
+
+    if not fname.endswith('.npz'):
+        with open(fname, 'rb') as i:
+            states, tstamps = pickle.load(i)
+
+        return from_states(states, tstamps, nobs)
+
+    npz = np.load(fname)
+
+    return PackedStates(npz['bits'], npz['tstamps'])
@@ -4,11 +4,18 @@
 import os
 import sys
 import shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pandas as pd
 import cPickle as pickle
 import plotting
 import bb_settings
+import lcstore
+import events
+import nightly
+import manifest
+import labelindex
 import datetime
 from dateutil import tz
 import scipy.misc as spm
@@ -125,7 +132,66 @@ def stretch_image(img, lim):
     return cimg.astype(np.uint8)
 
 
-def convert_raws(path, fac=1, gray=False):
+def quicklook_luts(hist, scl, gam=0.5, gscl=2.0, lim=(60, 200)):
+    """
+    Per-channel 8-bit lookup tables equivalent to white balancing by scl,
+    gamma_scale(..., gam, gscl) and stretch_image(..., lim) of an image with
+    the given channel histograms.
+
+    Parameters
+    ----------
+    hist : ndarray
+        Histograms (3 x 256) of the raw values of each channel.
+    scl : ndarray
+        White balance divisor of each channel.
+    gam, gscl : float, optional
+        Gamma and scaling (see gamma_scale).
+    lim : list, optional
+        Limits of the stretch (see stretch_image).
+
+    Returns
+    -------
+    ndarray
+        The lookup tables (3 x 256) uint8.
+    """
+
+    vals = np.arange(256)
+
+    # -- white balance and gamma of every possible value
+    gamma = np.array([gamma_scale((vals / scl[c]).clip(0, 255).astype(np.uint8), gam, gscl)
+                      for c in range(3)])
+
+    # -- image-wide stretch limits from the values present
+    used = gamma[hist > 0].clip(lim[0], lim[1]).astype(float)
+    lo   = used.min()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fac = 255.0 / (used.max() - lo)
+
+        return ((gamma.clip(lim[0], lim[1]).astype(float) - lo) * fac).astype(np.uint8)
+
+
+def convert_raw(fname, imname, fac=1, scl=(1.0, 1.0, 1.0)):
+    """
+    Convert a raw file to a stretched, gamma corrected jpg quicklook by
+    applying per-channel lookup tables to the Bayer planes.
+    """
+
+    raw    = read_raw(fname)
+    planes = [raw[::2, 1::2][::fac, ::fac], raw[::2, ::2][::fac, ::fac],
+              raw[1::2, ::2][::fac, ::fac]]
+
+    hist = np.array([np.bincount(pl.ravel(), minlength=256) for pl in planes])
+    luts = quicklook_luts(hist, np.asarray(scl))
+
+    img = np.empty(planes[0].shape + (3,), dtype=np.uint8)
+    for c in range(3):
+        img[..., c] = luts[c][planes[c]]
+
+    spm.imsave(imname, img)
+
+
+def convert_raws(path, fac=1, gray=False, nthreads=None):
     """
     Convert all raw files in a directory to jpg.  NOTE: Image size 
     and RGB are HARD CODED!
@@ -136,6 +202,8 @@ def convert_raws(path, fac=1, gray=False):
         Path to raw files.
     fac : int, optional
         Sampling of the image.
+    nthreads : int, optional
+        Number of files converted in parallel (default all cores).
     """
 
     # -- set the scaling
@@ -147,49 +215,108 @@ def convert_raws(path, fac=1, gray=False):
     # -- get the file names
     fnames = [os.path.join(path, i) for i in sorted(os.listdir(path))[100:2700] if 
               ".raw" in i]
+
+    # -- skip those already converted (one listing per output directory)
+    odirs  = set(os.path.dirname(i.replace("raw", "jpg")) for i in fnames)
+    done   = set(os.path.join(d, i) for d in odirs if os.path.isdir(d) for i in os.listdir(d))
+    fnames = [i for i in fnames if i.replace("raw", "jpg") not in done]
     nfiles = len(fnames)
 
-    # -- initialize the image
-    sh  = (3072 // (2 * fac), 4096 // (2 * fac), 3)
-    img = np.zeros(sh, dtype=np.uint8)
+    def convert(fname):
+        convert_raw(fname, fname.replace("raw", "jpg"), fac, scl)
 
-    # -- loop through files and convert
-    for ii, fname in enumerate(fnames):
-        imname = fname.replace("raw", "jpg")
-        if os.path.isfile(imname):
-            continue
+    # -- convert in a thread pool (lookups and jpg encoding release the GIL)
+    pool = ThreadPool(multiprocessing.cpu_count() if nthreads is None else nthreads)
+
+    for ii, _ in enumerate(pool.imap_unordered(convert, fnames)):
         if (ii + 1) % 25 == 0:
             print("\rworking on file {0:5} of {1:5}..." \
                       .format(ii + 1, nfiles)), 
             sys.stdout.flush()
-        img[...] = read_raw(fname, rgb=True)[::fac, ::fac]
-        spm.imsave(imname , stretch_image(gamma_scale((img / scl) \
-                       .clip(0, 255).astype(np.uint8), 0.5, 2.0), (60, 200)))
+
+    pool.close()
+    pool.join()
     print("")
 
 
 def get_timestamp(nights):
     """
     Nights = list of 2-tuples of (month,night): str fomrmat i.e. [("06","25")]
+
+    Returns a dict of local (New York) datetime64 arrays per night.
     """
     night_dict = {}
 
     for n in nights:
-        data_dir = os.path.join(bb_settings.DATA_FILEPATH, n[0], n[1])
-        night_dict[n] = [datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(
-            data_dir, file))) for file in sorted(os.listdir(data_dir))[100:2700]]
+        man = manifest.scan(os.path.join(bb_settings.DATA_FILEPATH, n[0], n[1]))
+        night_dict[n] = local_time(man.mtimes[100:2700])
 
     return night_dict
 
 
+def utc_offsets(start, stop, zone='America/New_York'):
+    """
+    Table of UTC offsets (in seconds) of a time zone for every hour between
+    two naive Unix timestamps (DST transitions fall on the hour).
+
+    Returns
+    -------
+    hour0 : int
+        Unix hour (timestamp // 3600) of the first entry.
+    offsets : ndarray
+        UTC offset of each hour.
+    """
+
+    zone  = tz.gettz(zone)
+    hour0 = int(start // 3600)
+    hours = np.arange(hour0, int(stop // 3600) + 1)
+
+    offsets = np.array([datetime.datetime.fromtimestamp(h * 3600, zone).utcoffset()
+                        .total_seconds() for h in hours], dtype=np.int64)
+
+    return hour0, offsets
+
+
+def local_time(tstamps, zone='America/New_York'):
+    """
+    Vectorized conversion of naive Unix timestamps to local wall-clock time
+    as datetime64[s] (NaT where a timestamp is NaN), using a per-hour table
+    of UTC offsets over the range of the timestamps.
+
+    Parameters
+    ----------
+    tstamps : array-like
+        Naive Unix timestamps (int or float).
+    zone : str, optional
+        tz database name of the local time zone.
+
+    Returns
+    -------
+    ndarray
+        Local times, same shape as tstamps.
+    """
+
+    tstamps = np.asarray(tstamps)
+    valid   = np.isfinite(tstamps)
+    secs    = np.where(valid, tstamps, 0).astype(np.int64)
+    out     = np.full(tstamps.shape, np.datetime64('NaT'), dtype='datetime64[s]')
+
+    if not valid.any():
+        return out
+
+    hour0, offsets = utc_offsets(secs[valid].min(), secs[valid].max(), zone)
+    local = secs[valid] + offsets[secs[valid] // 3600 - hour0]
+    out[valid] = local.astype('datetime64[s]')
+
+    return out
+
+
 def convert_tstamp(tstamps):
     '''
-    Reads in array of naive Unix timestamps and returns array of datetime objects localized to New York time.
+    Reads in array of naive Unix timestamps and returns array of datetime64
+    localized to New York time (see local_time).
     '''
-    # function to set local time
-    set_tz = np.vectorize(lambda x: datetime.datetime.utcfromtimestamp(x).replace(tzinfo=tz.gettz('America/New York')))
-
-    return set_tz(tstamps)
+    return local_time(tstamps)
 
 def clip_labels(cliptype='hsi', light_class='all'):
 
@@ -199,7 +326,7 @@ def clip_labels(cliptype='hsi', light_class='all'):
 
 
     if cliptype == 'hsi_mask':  # all sources in HSI mask
-        hsi_l, hsi_s = np.unique(bb_settings.FINAL_MASK, return_counts=True)
+        hsi_l, hsi_s = bb_settings.FINAL_INDEX.unique()
 
         return hsi_l
 
@@ -213,8 +340,7 @@ def clip_labels(cliptype='hsi', light_class='all'):
             return bb_settings.SPECTRA_CLASS[selector_msk][bb_settings.SPECTRA_CLASS.columns[-4]].values
 
     elif cliptype == 'gowanus':  # sources estimated to be in Gowanus public housing
-        new_hsi = bb_settings.FINAL_MASK[900:1200, 1400:2200].copy()
-        hsi_l, hsi_s = np.unique(new_hsi, return_counts=True)
+        hsi_l, hsi_s = bb_settings.FINAL_INDEX.crop((900, 1200), (1400, 2200)).unique()
 
         return hsi_l
 
@@ -227,15 +353,24 @@ def clip_labels(cliptype='hsi', light_class='all'):
         return bb_settings.LABELS[size_msk]
 
 
-def load_lc(cube=True, clip=None, light_class='all'):
+def load_lc(cube=True, clip=None, light_class='all', store=None):
     """
     Loads previously extracted lightcuves. 
     If cube = False, returns a 2-d array time series (num total multi night timesteps x num sources)
     If cube = True, it does so three-dimensionally by night (num nights x timestep/night x num sources)
 
     If clipping, set "clip" to cliptype and if cliptype='hsi', set 'light_class' (default 'all')
+
+    If store is set (path of a lcstore.LightcurveStore, e.g. bb_settings.STORE_PATH), reads
+    lazily from the store so that clipping only reads the selected sources from disk.
     """
 
+    if store is not None:
+        store = lcstore.LightcurveStore(store)
+        clip_idx = None if clip is None else clip_labels(cliptype=clip, light_class=light_class)
+
+        return store.read('curves', sources=clip_idx, cube=cube), store.tstamps(cube=cube)
+
     # get
     if cube:
         curves = np.empty((bb_settings.NUM_CURVES, bb_settings.CURVE_LENGTH, len(bb_settings.LABELS[1:])))
@@ -279,7 +414,70 @@ def load_lc(cube=True, clip=None, light_class='all'):
         return curves, tstamps
 
 
-def load_edges(cube=True, clip=None, light_class='all'):
+def load_edges(cube=True, clip=None, light_class='all', store=None, dense=True):
+    """
+    Loads previously detected edges as (lcs, lcgds, ons, offs, tstamps).
+
+    If store is set (path of a lcstore.LightcurveStore), the lightcurves are
+    read lazily from the store so that clipping only reads the selected
+    sources from disk.  The gd, ons and offs arrays are read from the store
+    for nights imported from pickles, and otherwise rebuilt from the night's
+    event table in EDGE_PATH (nights with neither are skipped).
+
+    Edges are read from event tables (edge_events_MM_DD.npz) or legacy edge
+    pickles.  If dense is False, the nights are returned as a list of
+    events.EdgeEvents without rebuilding the dense arrays (legacy pickles are
+    converted); clipping keeps the events of the selected sources, with their
+    original source indices, and cube and store do not apply.
+    """
+
+    if not dense:
+        evts = []
+
+        for i in sorted(os.listdir(bb_settings.EDGE_PATH)):
+            fname = os.path.join(bb_settings.EDGE_PATH, i)
+
+            if fname.endswith('.npz'):
+                evts.append(events.load(fname))
+            else:
+                lc, lcgd, on, off, ts = events.load_edges(fname)
+                evts.append(events.from_dense(on, off, lcgd, ts))
+
+        if clip is not None:
+            clip_idx = clip_labels(cliptype=clip, light_class=light_class)
+            evts     = [ev.subset(clip_idx) for ev in evts]
+
+        return evts
+
+    if store is not None:
+        store = lcstore.LightcurveStore(store)
+        clip_idx = None if clip is None else clip_labels(cliptype=clip, light_class=light_class)
+
+        edge_file = lambda n: os.path.join(bb_settings.EDGE_PATH, 'edge_events_{}.npz'.format(n))
+        nights = [n for n in store.nights if store.has('ons', n) or os.path.isfile(edge_file(n))]
+
+        lcs, lcgds, ons, offs = [], [], [], []
+
+        for n in nights:
+            lc = store.read('curves', sources=clip_idx, nights=[n], cube=False)
+
+            if store.has('ons', n):
+                gd, on, off = [store.read(name, sources=clip_idx, nights=[n], cube=False)
+                               for name in ('gd', 'ons', 'offs')]
+            else:
+                ev  = events.load(edge_file(n))
+                gd  = np.ma.getdata(events.gauss_diff(lc, ev.width, ev.delta))
+                on  = ev.dense(events.ON, clip_idx)
+                off = ev.dense(events.OFF, clip_idx)
+
+            lcs.append(lc)
+            lcgds.append(gd)
+            ons.append(on)
+            offs.append(off)
+
+        join = np.stack if cube else lambda arrs: np.concatenate(arrs, axis=0)
+
+        return join(lcs), join(lcgds), join(ons), join(offs), store.tstamps(nights, cube=cube)
 
     num_files = bb_settings.NUM_EDGES
 
@@ -293,8 +491,7 @@ def load_edges(cube=True, clip=None, light_class='all'):
         nidx = 0
 
         for i in sorted(os.listdir(bb_settings.EDGE_PATH)):
-            with open(os.path.join(bb_settings.EDGE_PATH, i), 'rb') as file:
-                lc, lcgd, on, off, ts = pickle.load(file)
+            lc, lcgd, on, off, ts = events.load_edges(os.path.join(bb_settings.EDGE_PATH, i))
 
             lcs[nidx, :, :] = lc
             lcgds[nidx, :, :] = lcgd
@@ -318,14 +515,13 @@ def load_edges(cube=True, clip=None, light_class='all'):
         nidx = 0
 
         for i in sorted(os.listdir(bb_settings.EDGE_PATH)):
-            with opn(os.path.join(bb_settings.EDGE_PATH, i), 'rb') as file:
-                lc, lcgd, on, off, ts = pickle.load(file)
+            lc, lcgd, on, off, ts = events.load_edges(os.path.join(bb_settings.EDGE_PATH, i))
 
             lcs.append(lc)
             lcgds.append(lcgd)
             ons.append(on)
             offs.append(off)
-            tstamps.app(ts)
+            tstamps.append(ts)
 
             nidx += 1
 
@@ -365,50 +561,30 @@ def last_off(offs, tstamps, clip=None, light_class='all', time_convert=False):
 
     Returns:
     --------
-        Array of time last off per source per night (nnights x nsources)
+        Array of time last off per source per night (nnights x nsources), as
+        local datetime64 (NaT if never off) if time_convert
     '''
     
-    num_files = bb_settings.NUM_EDGES
+    # index of the last off of each source per night (-1 if none)
+    last_idx  = nightly.from_dense(np.zeros(offs.shape, dtype=bool), offs).last_off
 
-    last_offs = np.empty((num_files, offs.shape[2]))
-
-    for i in range(num_files):
-        if_on = offs[i].T * tstamps[i]
-
-        if_on = np.max(if_on, axis=1)
-
-        if_on[if_on == 0.0] = None
-
-        last_offs[i, :] = if_on
+    last_offs = np.take_along_axis(np.asarray(tstamps, dtype=float), last_idx.clip(0), 1)
+    last_offs[last_idx < 0] = None
 
     if time_convert:
-        temp = np.ma.zeros(last_offs.shape)
-        temp[:,:] = last_offs
-        temp.mask = np.zeros_like(last_offs)
-        temp.mask[:,:] = np.isnan(last_offs)
-
-        def convert(data):
-            try:
-                return datetime.datetime.fromtimestamp(data)
-
-            except ValueError:
-                return np.ma.masked
-
-        cvect = np.vectorize(convert)
-
-        return cvect(temp).data
+        return local_time(last_offs)
 
     else:
         return last_offs
 
 
-def plot(data=bb_settings.LABELS_MASK, clip=None):
-    if clip is not None:
-        final_msk = np.isin(data, clip)
+def plot(data=None, clip=None):
+    index = bb_settings.LABELS_INDEX if data is None else labelindex.from_mask(data)
 
-        data[~final_msk] = 0
+    if clip is not None:
+        index = index.subset(clip)
 
-    plotting.quick_source_info(data, clim=None, oname=None)
+    plotting.quick_source_info(index.mask(), clim=None, oname=None, index=index)
 
     return
 
@@ -4,6 +4,9 @@
 import os
 import numpy as np
 import duration_plot
+import manifest
+import states as packed_states
+import labelindex
 # import utils
 import cPickle as pickle
 import time
@@ -17,14 +20,15 @@ NUM_OBS = 1700
 # TSTEPS = 10.0
 
 DPATH = os.path.join(os.environ['REBOUND_DATA'], 'bb', '2017')
-ON_STATES = os.path.join(os.environ['REBOUND_WRITE'],'circadian','light_states_tstamps_tuple.pkl')
+ON_STATES = os.path.join(os.environ['REBOUND_WRITE'],'circadian','light_states_packed.npz')
 gow_row = (900, 1200)
 gow_col = (1400, 2200)
-LABELS = np.load(os.path.join(os.environ['REBOUND_WRITE'], 'final', 'hsi_pixels3.npy'))[
-    gow_row[0]:gow_row[1], gow_col[0]:gow_col[1]]
+LABELS_INDEX = labelindex.from_file(os.path.join(os.environ['REBOUND_WRITE'], 'final', 'hsi_pixels3.npy')) \
+    .crop(gow_row, gow_col)
+LABELS = LABELS_INDEX.mask()
 
 BB_LABELS = np.load(os.path.join(os.environ['REBOUND_WRITE'],'final','labels.npy'))
-GOW_SRCS = np.unique(LABELS)[1:]
+GOW_SRCS = LABELS_INDEX.labels
 NIGHTS = [('07','29'),('07','30'),('08','01'),('08','02'),('08','03'),('08','04'),('08','05'),
           ('08','06'),('08','07'),('08','08'),('08','09'),('08','10'),('08','11'),('08','12'),
           ('08','13'),('08','14'),('08','15'),('08','16'),('08','17'),('08','18'),('08','19')]
@@ -55,12 +59,10 @@ def rg8_to_rgb(img):
 
 def load_states(spath=ON_STATES):
     '''
-    spath : path to pickle object of broadband state array and timestamps
+    spath : path to packed broadband states (.npz) or legacy pickle object of
+    broadband state array and timestamps; returns states.PackedStates
     '''
-    with open(spath, 'rb') as i:
-        states, bb_tstamps = pickle.load(i)
-
-    return states, bb_tstamps
+    return packed_states.load(spath)
 
 def calc_rgb(start=0, stop=14, step=30, gow=True):
     '''
@@ -80,14 +82,16 @@ def calc_rgb(start=0, stop=14, step=30, gow=True):
     nights = NIGHTS[start:stop]
 
     # mask for Gow sources
+    bb_index = labelindex.from_file(os.path.join(os.environ['REBOUND_WRITE'],'final','labels.npy'))
     if gow:
-        mask = np.in1d(BB_LABELS, GOW_SRCS).reshape(BB_LABELS.shape)
-    else:
-        mask = BB_LABELS>0
+        bb_index = bb_index.subset(GOW_SRCS)
+
+    mask = np.zeros(BB_LABELS.shape, dtype=bool)
+    mask.flat[bb_index.pixels] = True
 
 
     print "loading flist..."
-    flist = [os.path.join(DPATH,n[0],n[1],i) for n in nights for i in sorted(os.listdir(os.path.join(DPATH, n[0], n[1])))[:NUM_OBS:step]]
+    flist = [i for n in nights for i in manifest.scan(os.path.join(DPATH, n[0], n[1])).paths(stop=NUM_OBS, step=step)]
 
     print "loading and stacking bb memmaps..."
     data = np.empty((len(flist), BB_LABELS.shape[0],BB_LABELS.shape[1]),dtype=np.float64)
@@ -122,10 +126,11 @@ def calc_rgb(start=0, stop=14, step=30, gow=True):
     g = np.divide(G, RGB, out = np.zeros_like(G), where = RGB != 0)
     b = np.divide(B, RGB, out = np.zeros_like(B), where = RGB != 0)
 
-    if gow:
-        rb_matrix = np.asarray([[r[maskrgb==i].mean(), g[maskrgb==i].mean(), b[maskrgb==i].mean()] for i in GOW_SRCS])
-    else:
-        rb_matrix = np.asarray([[r[maskrgb==i].mean(), g[maskrgb==i].mean(), b[maskrgb==i].mean()] for i in np.unique(BB_LABELS)[1:]])
+    # mean color ratios over the pixels of each source (nan if not in maskrgb)
+    rgb_index = labelindex.from_mask(maskrgb)
+    srcs = GOW_SRCS if gow else bb_index.labels
+
+    rb_matrix = np.asarray([rgb_index.mean(r, srcs), rgb_index.mean(g, srcs), rgb_index.mean(b, srcs)]).T
 
     print "Time to run: {}".format(time.time() - time_start)
 
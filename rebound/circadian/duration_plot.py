@@ -8,11 +8,12 @@ import cPickle as pickle
 import time
 import datetime
 import pylab as pl
+import states as packed_states
 
 # ---> GLOBAL VARIABLES
 NUM_OBS = 2700
 TSTEPS = 10.0
-ON_STATES = os.path.join(os.environ['REBOUND_WRITE'],'circadian','light_states_tstamps_tuple.pkl')
+ON_STATES = os.path.join(os.environ['REBOUND_WRITE'],'circadian','light_states_packed.npz')
 gow_row = (900, 1200)
 gow_col = (1400, 2200)
 LABELS = np.load(os.path.join(os.environ['REBOUND_WRITE'], 'final', 'hsi_pixels3.npy'))[
@@ -22,33 +23,17 @@ RGB_MATRIX = np.load(os.path.join(os.environ['REBOUND_WRITE'],'circadian','rgb_m
 
 def load_states(spath=ON_STATES):
     '''
-    spath : path to pickle object of broadband state array and timestamps
+    spath : path to packed broadband states (.npz) or legacy pickle object of
+    broadband state array and timestamps; returns states.PackedStates
     '''
-    with open(spath, 'rb') as i:
-        states, bb_tstamps = pickle.load(i)
-
-    return states, bb_tstamps
+    return packed_states.load(spath, NUM_OBS)
 
 def calc_dur(states):
     '''
-    Takes states output array from load_states() method
-    create array of nnights x nsrcs
+    Takes states.PackedStates output from load_states() method
+    create array of nnights x nsrcs (on time counted from the packed bits)
     '''
-    nnights = states.shape[0]/NUM_OBS
-    nsrcs = GOW_SRCS.shape[0]
-
-    gow_states = states[:,GOW_SRCS] # create array of desired labels
-
-    states_time = gow_states * TSTEPS # multipy by time on for each timestep
-
-    duration = np.empty((nnights, nsrcs), dtype=np.float64)
-
-    for i in range(nnights):
-        start = i*NUM_OBS
-        end = start+NUM_OBS
-        duration[i,:] = states_time[start:end, :].sum(axis=0)
-
-    return duration
+    return states.duration(GOW_SRCS, TSTEPS)
 
 def plot_dur(data, sort_day, n_thresh=0.05, cm='hot', oname=None):
     '''
@@ -5,6 +5,7 @@ import os
 import numpy as np
 # import duration_plot
 import cPickle as pickle
+import nightly
 import scipy.stats as stats
 # import time
 # import datetime
@@ -27,17 +28,11 @@ def color_last_off(gow=True):
     ADD DOCS!
     '''
 
-    flist = [f for f in sorted(os.listdir(DPATH))]
-
-    last_cube = np.empty((len(flist), NUM_SRCS))
-
-    for f in range(len(flist)):
-        with open(os.path.join(DPATH,flist[f]), 'rb') as file:
-            _, _, _, last_off, ts = pickle.load(file)
-        last_cube[f,:] = (last_off.T * np.arange(0,NUM_OBS)).max(axis=1)
+    # last off index per night and source, -1 if none (cached by nightly.load)
+    last_cube = nightly.load(DPATH).last_off.astype(float)
 
     # get mean only for nights with light on
-    masked= np.ma.masked_array(last_cube, mask=last_cube==0)
+    masked= np.ma.masked_array(last_cube, mask=last_cube<0)
 
     mean_lo = np.mean(masked, axis=0).data
 
@@ -5,7 +5,8 @@ import os
 import numpy as np
 import pandas as pd
 import utils
-import cPickle as pickle
+import events
+import states as packed_states
 import time
 import datetime
 from dateutil import tz
@@ -25,64 +26,58 @@ def on_state(ons, offs, tstamp=None):
     '''
     Takes on and off indices (num obs x num sources) and returns a 2-d array
     that expresses true if light is on (nobs x nsources)
-    '''
-    lights_on = np.zeros((ons.shape[0], ons.shape[
-                         1]), dtype=bool)  # boolean of light state per obs x source
-    # current state of each light source: on/off
-    state = np.zeros((ons.shape[1]), dtype=bool)
 
-    # forward pass
-    for i in range(ons.shape[0]):
+    ons and offs may also be stacked over nights (num nights x num obs x
+    num sources), in which case all nights are propagated at once and a
+    3-d array is returned.
+    '''
+    nobs = ons.shape[-2]
 
-        # turn state on if "on" index true (or keep on if previously on)
-        state = ons[i, :] | state
+    lights_on = np.empty(ons.shape, dtype=bool)  # boolean of light state per obs x source
+    # current state of each light source: on/off
+    state = np.zeros(ons.shape[:-2] + ons.shape[-1:], dtype=bool)
 
-        state = (state & ~offs[i, :])  # turn state off if "off" index true
+    # forward pass: on if the last event at or before i is an "on"
+    for i in range(nobs):
 
-        lights_on[i, :] = state 	# set light state at each timestep
+        state |= ons[..., i, :]   # turn state on if "on" index true
+        state &= ~offs[..., i, :] # turn state off if "off" index true
 
-    # reverse indices and reset state
-    lights_on = lights_on[::-1, :]
-    ons = ons[::-1, :]
-    offs = offs[::-1, :]
-    state = np.zeros((ons.shape[1]), dtype=bool)
+        lights_on[..., i, :] = state
 
-    # backward pass
-    for i in range(ons.shape[0]):
+    # backward pass: on if the next event at or after i is an "off"
+    # note that in reverse the "off" index is the "on"
+    state[...] = False
 
-        # turn state on if "on" index true (or keep on if previously on)
-        # note that in reverse the "off" index is the "on"
-        state = offs[i, :] | state
+    for i in range(nobs - 1, -1, -1):
 
-        state = (state & ~ons[i, :])  # turn state off if "off" index true
+        state |= offs[..., i, :]
+        state &= ~ons[..., i, :]
 
         # set light state at each timestep, but ignore if previous True
-        lights_on[i, :] = lights_on[i, :] | state
+        lights_on[..., i, :] |= state
 
     if tstamp is not None:
-        # return lights on array (reversed back to original)
-        return lights_on[::-1, :], tstamp
+        return lights_on, tstamp
     else:
-        return lights_on[::-1, :]
+        return lights_on
 
 
-def multi_night(input_dir, output_dir):
+def multi_night(input_dir, output_dir, batch=7):
     '''
     From input of director reads in on/off indices from edge object produced
-    by detect_onoff and returns a 2-D array that expresses True if a light
-    source is on (nobs across all nights x nsources)
+    by detect_onoff and saves the light states (True if a light source is
+    on) bit-packed along time as states.PackedStates in
+    output_dir/light_states_packed.npz
 
     Parameters:
     -----------
     input_dir : str
-            Filepath for directory with edge objects.
-
-            Each edge object is a tuple with component at index:
-            0: lightcurves
-            1: lc after Gaussian filter
-            2: on indices
-            3: off indices
-            4: timestamp (index)
+            Filepath for directory with edge event tables (.npz) or legacy
+            edge objects.  Only the on/off indices and timestamps are read.
+
+    batch : int
+            Number of nights whose states are computed together.
     '''
     start = time.time()
 
@@ -92,33 +87,35 @@ def multi_night(input_dir, output_dir):
     all_tstamps = []
 
 
-    # initialize  empty array
-    light_states = np.empty((num_nights*NUM_OBS, NUM_SOURCES), dtype=bool)
+    # initialize  empty array of states bit-packed along time
+    light_states = np.empty((num_nights, NUM_SOURCES, (NUM_OBS + 7) // 8), dtype=np.uint8)
 
-    idx = 0
+    fnames = sorted(os.listdir(input_dir))
 
-    for i in sorted(os.listdir(input_dir)):
-        start_night = time.time()
-        print("Loading {}".format(i))
+    for b in range(0, num_nights, batch):
+        start_batch = time.time()
 
-        with open(os.path.join(input_dir, i), 'rb') as p:
-            edge = pickle.load(p)
+        # stack a batch of nights so that their states are propagated at once
+        ons  = np.zeros((len(fnames[b:b+batch]), NUM_OBS, NUM_SOURCES), dtype=bool)
+        offs = np.zeros_like(ons)
 
-        # append timestamp
-        all_tstamps.append(edge[4])
+        for n, i in enumerate(fnames[b:b+batch]):
+            print("Loading {}".format(i))
+            ons[n], offs[n], tstamps = events.load_onoff(os.path.join(input_dir, i))
 
-        print('Determining on state for {}'.format(i))
+            # append timestamp
+            all_tstamps.append(tstamps)
+
+        print('Determining on state for {} nights'.format(len(ons)))
         # run on_state
-        light_states[idx:idx+NUM_OBS, :] = on_state(ons=edge[2], offs=edge[3])
+        light_states[b:b+len(ons)] = packed_states.pack(on_state(ons=ons, offs=offs), NUM_OBS)
 
-        idx += NUM_OBS
-        print('Time for {}: {}'.format(i, time.time() - start_night))
+        print('Time for batch: {}'.format(time.time() - start_batch))
 
     all_tstamps = np.concatenate(all_tstamps)
 
-    with open(os.path.join(output_dir, 'light_states_tstamps_tuple.pkl'), 'wb') as file:
-        l = light_states, all_tstamps
-        pickle.dump(l, file, pickle.HIGHEST_PROTOCOL)
+    packed_states.PackedStates(light_states, all_tstamps.reshape(-1, NUM_OBS)) \
+        .save(os.path.join(output_dir, 'light_states_packed.npz'))
 
     print('Total time for {} nights: {}'.format(
         num_nights, time.time() - start))
@@ -127,17 +124,16 @@ def multi_night(input_dir, output_dir):
 
 def load_states(spath):
     '''
-    spath : path to pickle object of broadband state array and timestamps
+    spath : path to packed broadband states (.npz) or legacy pickle object of
+    broadband state array and timestamps; returns states.PackedStates
     '''
-    with open(spath, 'rb') as i:
-        states, bb_tstamps = pickle.load(i)
-
-    return states, bb_tstamps
+    return packed_states.load(spath, NUM_OBS)
 
 
-def precision_stack(input_dir, month, night, states, bb_tstamps, window=5, step=1, clean=False):
+def precision_stack(input_dir, month, night, states, window=5, step=1, clean=False):
     '''
     Input_dir : path to HSI raw files
+    states : states.PackedStates of broadband light states
     opath : path to save stacked scans
     window : temporal window within which to stack (in minutes)
     clean : if true, subtract the mean from raw file prior to stacking
@@ -163,10 +159,10 @@ def precision_stack(input_dir, month, night, states, bb_tstamps, window=5, step=
             min_bound = hsi_tstamp - window * 60
             max_bound = hsi_tstamp + window * 60
 
-            # indices of states index that are in window                                                                            
-            states_win = states[(bb_tstamps < max_bound) & (bb_tstamps > min_bound), :]
-            
-            if states_win.shape[0] == 0:
+            # any broadband observations in window
+            in_win = ((states.tstamps < max_bound) & (states.tstamps > min_bound)).any()
+
+            if not in_win:
                  print "No broadband image during window (i.e. truncated for daylight)..."
 
             else:
@@ -178,27 +174,23 @@ def precision_stack(input_dir, month, night, states, bb_tstamps, window=5, step=
 
                 # data = utils.read_hyper(fpath).data[:,900:1200,1400:2200].copy()
 
-                data = np.memmap(fpath, np.uint16, mode="r").copy()
+                # -- read only the Gowanus region's byte ranges
+                data = utils.read_roi(fpath, gow_row, gow_col, shape=sh)
 
                 print "Time to read in file {}".format(time.time() - t2)
 
-                t2a = time.time()
-                data = data.reshape(sh[2], sh[0], sh[1])[:, :, ::-1] \
-                .transpose(1, 2, 0)[:, 900:1200, 1400:2200]
-
                 t3 = time.time()
-                print "Time to reshape and slice: {}".format(time.time() - t2a)
 
                 print"Data shape is: {}".format(data.shape)
 
                 print("Creating mask...")
 
-                t_idx = np.any(states_win, axis = 0)
+                t_idx = states.any_on(min_bound, max_bound)
 
                 mask3d = np.empty(data.shape)
 
                 # shifting np.arange() list right by 1 to adjust for removing the 0 label in an earlier method
-                mask3d[:, :, :] = np.in1d(LABELS, np.arange(1, states.shape[1]+1)[t_idx]).reshape(LABELS.shape)[np.newaxis, :, :]
+                mask3d[:, :, :] = np.in1d(LABELS, np.arange(1, states.nsrc+1)[t_idx]).reshape(LABELS.shape)[np.newaxis, :, :]
 
                 mask3d = mask3d.astype(bool)
 
@@ -236,12 +228,12 @@ def multi_stack(input_dir, spath, opath, night_list=NIGHTS, window=5, step=1, cl
     t0 = time.time()
     # load array of light states and timestamps
     print "Loading on states array and timestamps..."
-    states, bb_ts = load_states(spath)
+    states = load_states(spath)
 
     for n in night_list:
 
         stacked = precision_stack(input_dir=input_dir, month = n[0], night = n[1], 
-        states = states, bb_tstamps = bb_ts, window=window, step=step, clean=clean)
+        states = states, window=window, step=step, clean=clean)
 
         output = os.path.join(opath,"stacked_{}_{}.raw".format(n[0],n[1]))
 
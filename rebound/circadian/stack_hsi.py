@@ -49,12 +49,9 @@ def boxed_stack(input_mask, input_dir, scale_factor, step, opath):
         
             print('reading {}...'.format(i))
 
-            # reads in scan, shape ncol x nwav x nrow, reverse row, reshape to nwav, nrow, ncol
-            data = np.memmap(os.path.join(input_dir,i), np.uint16, mode='r').reshape(
-            sh[2], sh[0], sh[1])[:,:,::-1].transpose(1,2,0)
-
-            # truncate to bounding box dimensions and scale
-            data = data[:,rmin:rmax,cmin:cmax]*1.0/scale_factor
+            # reads in only the bounding box of the scan (nwav, nrow, ncol) and scale
+            data = utils.read_roi(os.path.join(input_dir,i), (rmin,rmax), (cmin,cmax),
+                                  shape=sh)*1.0/scale_factor
 
             scan_list.append(data.astype(np.uint16))
 
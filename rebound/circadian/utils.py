@@ -4,7 +4,10 @@
 import os
 import settings
 import numpy as np
+import bil
 from scipy import ndimage as nd
+from aggregate import LabelAggregator
+import labelindex
 
 
 def read_header(hdrfile, verbose=False):
@@ -134,7 +137,7 @@ def read_hyper(fpath, fname=None, full=True):
     return output(fpath)
 
 
-def read_hsi(input_dir, rawfile, sh):
+def read_hsi(input_dir, rawfile, sh, rows=None, cols=None, bands=None):
     '''
     Reads in raw file with no header.
 
@@ -149,18 +152,39 @@ def read_hsi(input_dir, rawfile, sh):
     sh : tuple (Default reads in (848, 1600, 3194))
             Desired file shape (nwav, nrow, ncol).
 
+    rows, cols, bands : tuple, optional
+            (start, stop) windows; if any is set only that region is read
+            from disk (see read_roi).
+
 
     Returns
     -------
-    cube = a numpy memmap of the HSI scan in shape (nwav, nrow, ncol)
+    cube = a numpy memmap of the HSI scan in shape (nwav, nrow, ncol), or a
+           contiguous array of the region if a window is set
     '''
 
     fpath = os.path.join(input_dir, rawfile)
 
+    if rows is not None or cols is not None or bands is not None:
+        return read_roi(fpath, rows, cols, bands, shape=sh)
+
     return np.memmap(fpath, np.uint16, mode='r').reshape(
     	sh[2], sh[0], sh[1])[:,:,::-1].transpose(1, 2, 0)
 
 
+def read_roi(fpath, rows=None, cols=None, bands=None, shape=None, **kwargs):
+    """
+    Read a region of interest of a hyperspectral scan (see bil.read_roi),
+    taking the shape (nwav, nrow, ncol) from the header file if None.
+    """
+
+    if shape is None:
+        hdr   = read_header(fpath.replace("raw", "hdr"), verbose=False)
+        shape = (hdr["nwav"], hdr["nrow"], hdr["ncol"])
+
+    return bil.read_roi(fpath, shape, rows, cols, bands, **kwargs)
+
+
 def mask_box(input_mask):
     '''
     Create a bounding box around nonzero values in a numpy mask (e.g. Gowanus).
@@ -184,46 +208,55 @@ def mask_box(input_mask):
     return rmin, rmax, cmin, cmax
 
 
-def augment_mask(labels, min_thresh=3):
+def fill_from(labels, dr, dc):
     '''
-    Filter out broadband mask sources below minimum threshold and add pixels to left, right, up, down.
+    Copy of labels in which every background (0) pixel takes the label of
+    the pixel at (row - dr, col - dc), e.g. (1, 0) fills from the pixel
+    above.  The source pixels are read from the input, so a label grows by
+    at most one pixel.
     '''
-    uniq, size = np.unique(labels, return_counts=True)
-    in_labels = lambda x: x in uniq[size > min_thresh][1:]
+    nrow, ncol = labels.shape
+    out = labels.copy()
 
-    labels *= np.array([in_labels(x) for x in labels.flatten()]).reshape(labels.shape)
+    dst = out[max(dr, 0):nrow + min(dr, 0), max(dc, 0):ncol + min(dc, 0)]
+    src = labels[max(-dr, 0):nrow + min(-dr, 0), max(-dc, 0):ncol + min(-dc, 0)]
 
-    # need to vectorize!!
-    m = labels.copy()
+    zero = dst == 0
+    dst[zero] = src[zero]
 
-    for i in range(1, labels.shape[0]):
-        for j in range(0, labels.shape[1]):
-            if labels[i, j] == 0:
-                m[i, j] = labels[i-1, j]
+    return out
 
-    n = m.copy()
 
-    for i in range(0, labels.shape[0]):
-        for j in range(1, labels.shape[1]):
-            if m[i, j] == 0:
-                n[i, j] = m[i, j-1]
+def augment_mask(labels, min_thresh=3, shifts=((1, 0), (0, 1), (-1, 0))):
+    '''
+    Filter out broadband mask sources below minimum threshold and grow the remaining
+    sources into neighboring background pixels.
 
-    n = n[::-1,::-1]
-    o = n.copy()
+    Parameters
+    ----------
+    labels : 2-d numpy array
+        Label mask (0 is background); small sources are removed in place.
+    min_thresh : int
+        Sources of min_thresh pixels or fewer are removed.
+    shifts : sequence of (dr, dc)
+        Structuring element, applied in order: each step fills the background
+        pixels of the previous result from the pixel at (row - dr, col - dc)
+        (see fill_from).  The default (from above, from the left, from below)
+        reproduces the original loop implementation; add (0, -1) to also fill
+        from the right.
 
-    for i in range(1, labels.shape[0]):
-        for j in range(0, labels.shape[1]):
-            if n[i, j] == 0:
-                o[i, j] = n[i-1, j]
+    Returns
+    -------
+    Augmented label mask.
+    '''
+    labels[...] = labelindex.from_mask(labels).filter(min_size=min_thresh + 1).mask(labels.dtype)
 
-    p = o.copy()
+    out = labels
 
-    for i in range(0, labels.shape[0]):
-        for j in range(1, labels.shape[1]):
-            if o[i, j] == 0:
-                p[i, j] = o[i, j-1]
+    for dr, dc in shifts:
+        out = fill_from(out, dr, dc)
 
-    return o[::-1,::-1]
+    return out
 
 
 
@@ -298,20 +331,15 @@ def mean_spectra(scans, labels, gow=False, find_sum=False):
     if gow:
         labels = labels[gow_row[0]:gow_row[1], gow_col[0]:gow_col[1]]
 
-    idx = np.unique(labels)[1:] # array of labels without 0
-
-    src_spectra = []
+    # sparse label operator, array of labels without 0
+    agg = LabelAggregator(labels)
+    idx = agg.index
 
-    for i in range(scans.shape[0]):
-        if find_sum:
-            scan_mu = nd.measurements.sum(scans[i, :, :], labels, idx)
-        else:
-            scan_mu = nd.measurements.mean(scans[i, :, :], labels, idx)
-
-        scan_mu = scan_mu.reshape(scan_mu.shape[0], 1)
-        src_spectra.append(scan_mu)
-
-    src_array = np.concatenate(src_spectra, axis = 1)
+    # reduce all wavelength channels at once (nsrcs x nwav)
+    if find_sum:
+        src_array = agg.sum(scans).T
+    else:
+        src_array = agg.mean(scans).T
 
     s_dict = {}
     for s in range(idx.shape[0]):
@@ -3,8 +3,10 @@ import numpy as np
 import os
 import utils
 import scipy.ndimage.measurements as mm
+from aggregate import LabelAggregator
+from neighbor_corr import neighbor_corr
 
-def hyper_pixcorr(path, fname, thresh=0.3):
+def hyper_pixcorr(path, fname, thresh=0.3, nthreads=None):
 	'''
 	hyper_pixcorr takes an input of the hyperspectral image and the threshold
 	correlation values and gives an output boolean array of pixels that are 
@@ -22,6 +24,9 @@ def hyper_pixcorr(path, fname, thresh=0.3):
 	thresh = float
 	Threshold correlation value for masking the correlated sources
 
+	nthreads = int
+	Number of threads for the correlations (default all cores)
+
 	Output:
 	------------
 	final_mask = np.array
@@ -41,12 +46,10 @@ def hyper_pixcorr(path, fname, thresh=0.3):
 	img -= img.mean(0, keepdims=True)
 	img /= img.std(0, keepdims=True)
 
-	# Computing the correlations between the left-right pixels
-	corr_x = (img[:,:-1,:] * img[:,1:,:]).mean(0)
+	# Computing the correlations between the left-right and top-down pixels
+	# in row bands across nthreads threads
+	corr_x, corr_y = neighbor_corr(img, nthreads=nthreads)
 	corr_x = corr_x[:,:-1]
-
-	# Computing the correlations between the top-down pixels
-	corr_y = (img[:,:,:-1] * img[:,:,1:]).mean(0)
 	corr_y = corr_y[:-1,:]
 
 	# Splitting the top-botton part of the image
@@ -103,16 +106,12 @@ def sptr_mean(path, fname, boolean_mask):
 	labels, count = mm.label(mask)
 
 	index = np.arange(count+1)
-	sptr_stack = []
-
-	for i in range(0,img.shape[0]):
-		channel = img[i,:-1,:-1]
-		src_mean = mm.mean(channel, labels, index)
-		sptr_stack.append(src_mean)   #redund
-		#sptr_stack = np.array(sptr_stack)    #redund	
-		#sources = np.array([sptr_stack[:,i] for i in range(count)])   #redund
+
+	# Mean of every channel across source pixels in one sparse product per batch
+	agg = LabelAggregator(labels, index)
+	sptr_stack = agg.mean(img[:,:-1,:-1])
     
-	return np.array(sptr_stack)
+	return sptr_stack
 
 
 
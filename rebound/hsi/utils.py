@@ -3,6 +3,7 @@
 
 import os
 import numpy as np
+import bil
 
 def read_header(hdrfile, verbose=True):
     """
@@ -128,3 +129,16 @@ def read_hyper(fpath, fname=None, full=True):
             self.ncol     = sh[2]
 
     return output(fpath)
+
+
+def read_roi(fpath, rows=None, cols=None, bands=None, shape=None, **kwargs):
+    """
+    Read a region of interest of a hyperspectral scan (see bil.read_roi),
+    taking the shape (nwav, nrow, ncol) from the header file if None.
+    """
+
+    if shape is None:
+        hdr   = read_header(fpath.replace("raw", "hdr"), verbose=False)
+        shape = (hdr["nwav"], hdr["nrow"], hdr["ncol"])
+
+    return bil.read_roi(fpath, shape, rows, cols, bands, **kwargs)